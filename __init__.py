@@ -1,3 +1,4 @@
+import provider
 import shipper
 from livesettings import config_choice_values
 
@@ -9,3 +10,35 @@ def get_methods():
 
     return [shipper.Shipper(service_type=value) for value in \
         config_choice_values('singpost', 'SINGPOST_SHIPPING_CHOICES')]
+
+def get_methods_by_cost(cart, contact):
+    '''
+    Returns (cost, shipper) pairs for every enabled choice that can ship
+    the cart to the contact, cheapest first.
+    '''
+
+    methods = get_methods()
+    for method in methods:
+        method.calculate(cart, contact)
+
+    return list(shipper.shippers_by_cost(methods))
+
+def get_cheapest_method(cart, contact):
+    '''
+    Returns the (cost, shipper) pair of the cheapest enabled choice, or None.
+    '''
+
+    methods = get_methods()
+    for method in methods:
+        method.calculate(cart, contact)
+
+    return shipper.cheapest_shipper(methods)
+
+def get_rate_provider():
+    '''
+    Returns a rate provider quoting every enabled choice, to compare rates
+    with other carriers.
+    '''
+
+    return provider.SingPostRateProvider([code for code, description in \
+        config_choice_values('singpost', 'SINGPOST_SHIPPING_CHOICES')])
@@ -0,0 +1,50 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+"""
+Keeps the parcel plans Shipper priced a cart with, so that the plan of the
+service chosen at checkout can be stored with the order instead of being
+worked out again for the manifest.
+
+Satchmo prices the chosen service and copies the cart into the order in the
+same request, so the plans are kept per thread, for the last cart priced.
+"""
+import threading
+
+from tiers import plan_to_dict
+
+_local = threading.local()
+
+def remember_plan(cart, service_type_code, lines, plan):
+    """
+    Keeps the plan of a service for cart, made from lines, in this thread,
+    replacing those of any other cart.
+    """
+    cart_id = getattr(cart, 'id', None)
+    if cart_id is None:
+        return
+
+    remembered = getattr(_local, 'plans', None)
+    if remembered is None or remembered[0] != cart_id:
+        remembered = (cart_id, {})
+        _local.plans = remembered
+
+    remembered[1][service_type_code] = (lines, plan)
+
+def checkout_plan(cart, service_type_code, cartitem):
+    """
+    Returns the plan kept for a service and cart as plan_to_dict() does,
+    if cartitem is the first line it was made from, or None.
+    """
+    remembered = getattr(_local, 'plans', None)
+    if remembered is None or remembered[0] != cart.id:
+        return None
+
+    lines, plan = remembered[1].get(service_type_code, (None, None))
+    if plan is None or not lines or lines[0].id != cartitem.id:
+        return None
+
+    return plan_to_dict(plan, lines)
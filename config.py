@@ -7,6 +7,8 @@ Please see LICENCE for licensing details.
 from django.utils.translation import ugettext_lazy as _
 from livesettings import *
 
+from tiers import SERVICE_TYPE_CODES, service_type_choices
+
 SHIP_MODULES = config_get('SHIPPING', 'MODULES')
 SHIP_MODULES.add_choice(('singpost', 'SingPost'))
 
@@ -21,19 +23,14 @@ config_register_list(
     MultipleStringValue(SHIPPING_GROUP,
         'SINGPOST_SHIPPING_CHOICES',
         description=_("SingPost shipping choices available to customers."),
-        choices = (
-            (('LOCAL', 'Local mail (inclusive of 7% GST)')),
-            (('LOCAL_REGISTERED', 'Local mail, registered (inclusive of 7% GST)')),
-
-            (('SURFACE', 'Surface mail (0% GST)')),
-            (('SURFACE_REGISTERED', 'Surface mail, registered (0% GST)')),
+        choices = service_type_choices(),
+        default = SERVICE_TYPE_CODES),
 
-            (('AIR', 'Airmail (0% GST)')),
-            (('AIR_REGISTERED', 'Airmail, registered (0% GST)')),
-        ),
-        default = (
-            'LOCAL', 'LOCAL_REGISTERED',
-            'SURFACE', 'SURFACE_REGISTERED',
-            'AIR', 'AIR_REGISTERED',
-        )),
+    BooleanValue(SHIPPING_GROUP,
+        'SINGPOST_PROFILING',
+        description=_("Profile SingPost shipping cost calculations"),
+        help_text=_("Logs the time and memory used by every calculation as " \
+            "JSON to the singpost.profiling logger. Where tracemalloc is " \
+            "installed, calculations are measured one at a time."),
+        default = False),
 )
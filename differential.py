@@ -0,0 +1,368 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+"""
+Differential testing of the pricing engine.
+
+Random carts and destinations are priced with a frozen copy of the original
+partitioning and pricing algorithm, and with the engine as it is now (the
+parcel plans Shipper prices from and the incremental CartQuote), and any
+difference in cost or number of shipments is reported. Both sides read the
+same rate card, so only the algorithms are compared.
+
+Nothing here needs Django; run it directly with
+
+    python differential.py --cases 10000 --seed 1
+"""
+try:
+    from decimal import getcontext, Decimal
+except:
+    from django.utils._decimal import getcontext, Decimal
+
+import logging
+import random
+import re
+import sys
+import time
+
+from quote import CartQuote
+from synthetic import COUNTRIES, CartItem, Country, Product
+from tiers import SERVICE_TYPE_CODES as SERVICES, HAS_SURCHARGE_PATTERN, \
+    current_rate_card, ineligibility_for_lines, safe_get_decimal, \
+    plan_shipments
+
+# the weights at which some tier changes price, and where shipments are split
+BOUNDARY_WEIGHTS = (20, 40, 50, 100, 250, 500, 1000, 2000)
+
+#
+# The original algorithm, kept as it was. Do not change this to follow the
+# engine; it is what the engine is checked against.
+#
+
+def _reference_explicit_cost(tier, shipment_weight):
+    if (shipment_weight > tier.maximum_item_weight):
+        return None
+
+    prev = None
+    result_cost = None
+
+    for weight, cost in tier.tiers:
+        if shipment_weight <= Decimal(weight):
+            if prev:
+                if shipment_weight > Decimal(prev):
+                    result_cost = cost
+                    break
+        else:
+            prev = weight
+
+    return result_cost
+
+def _reference_implicit_cost(tier, shipment_weight):
+    max_tier = reduce(lambda x, y: x if x > y else y, tier.tiers)
+
+    if (shipment_weight <= max_tier[0]):
+        prev = None
+        result_cost = None
+
+        for weight, cost in tier.tiers:
+            if shipment_weight <= Decimal(weight):
+                if prev:
+                    if shipment_weight > Decimal(prev):
+                        result_cost = cost
+                        break
+            else:
+                prev = weight
+    else:
+        result = getcontext().divmod(
+            Decimal(shipment_weight - max_tier[0]),
+            Decimal(tier.implied_tier[0]))
+        steps = result[0] + (1 if result[1] > Decimal(0) else 0)
+        result_cost = max_tier[1] + steps * tier.implied_tier[1]
+
+    return result_cost
+
+def _reference_partitioned_shipments(tier, total_weight, cartitems):
+    shipments = []
+    a_shipment = []
+
+    if total_weight < tier.maximum_item_weight:
+        for cartitem in cartitems:
+            for i in xrange(cartitem.quantity):
+                a_shipment.append(cartitem)
+    else:
+        the_weight = Decimal(0)
+        new_weight = None
+        for cartitem in cartitems:
+            for i in xrange(cartitem.quantity):
+                product_weight = safe_get_decimal(cartitem.product.weight)
+                new_weight = the_weight + product_weight
+
+                if new_weight <= tier.maximum_item_weight:
+                    the_weight = new_weight
+                    a_shipment.append(cartitem)
+
+                    if new_weight == tier.maximum_item_weight:
+                        shipments.append(a_shipment)
+                        a_shipment = []
+                elif len(a_shipment) > 0 and the_weight > Decimal(0):
+                    shipments.append(a_shipment)
+                    a_shipment = [cartitem]
+                    the_weight = product_weight
+                else:
+                    return None
+
+    if len(a_shipment):
+        shipments.append(a_shipment)
+
+    return shipments
+
+def _reference_tier(service_type_code, country):
+    tier_code = service_type_code
+
+    m = re.match(HAS_SURCHARGE_PATTERN, service_type_code)
+    if m:
+        tier_code = m.group(1)
+
+    tier = current_rate_card().service_tiers[tier_code]
+
+    if not tier.filter.country_is_included(country):
+        return None
+
+    if tier.tiers == None and hasattr(tier, 'zones'):
+        for zone in tier.zones:
+            if zone.filter.country_is_included(country):
+                return zone
+        return None
+
+    return tier
+
+def _reference_surcharge(service_type_code, country):
+    m = re.match(HAS_SURCHARGE_PATTERN, service_type_code)
+    if not m:
+        return Decimal(0)
+
+    s = None
+    for surcharge in current_rate_card().registered_surcharge:
+        if surcharge.filter.country_is_included(country):
+            s = surcharge
+
+    if not s:
+        return Decimal(0)
+
+    return s.charge
+
+def reference_quote(service_type_code, country, cartitems):
+    """
+    Returns (cost, number of shipments) as priced by the original algorithm,
+    or (None, None) if the service can't be used.
+    """
+    tier = _reference_tier(service_type_code, country)
+    if tier == None:
+        return None, None
+
+    if hasattr(tier, 'implied_tier'):
+        cost_for_weight = _reference_implicit_cost
+    else:
+        cost_for_weight = _reference_explicit_cost
+
+    total_weight = Decimal(0)
+    for cartitem in cartitems:
+        if cartitem.product.is_shippable:
+            total_weight += safe_get_decimal(cartitem.product.weight) * \
+                            safe_get_decimal(cartitem.quantity)
+
+    shipments = _reference_partitioned_shipments(tier, total_weight, cartitems)
+    if shipments == None or not len(shipments):
+        return None, None
+
+    surcharge = _reference_surcharge(service_type_code, country)
+    lowest_cost = reduce(lambda x, y: x if x < y else y, tier.tiers)[1]
+
+    total_cost = Decimal(0)
+    for shipment in shipments:
+        shipment_weight = Decimal(0)
+        for cartitem in shipment:
+            if cartitem.product.is_shippable:
+                shipment_weight += safe_get_decimal(cartitem.product.weight)
+
+        cost = cost_for_weight(tier, shipment_weight)
+        if cost is None:
+            cost = lowest_cost
+
+        total_cost += cost + surcharge
+
+    return total_cost, len(shipments)
+
+#
+# The engine as it is now.
+#
+
+def engine_quote(service_type_code, country, cartitems):
+    """
+    Returns (cost, number of shipments) of the ParcelPlan Shipper.cost() is
+    priced from, or (None, None) if the service can't be used.
+    """
+    plan = plan_shipments(service_type_code, country, cartitems)
+    if plan == None:
+        return None, None
+
+    return plan.cost, len(plan.parcels)
+
+def incremental_quote(country, cartitems, previous):
+    """
+    Returns a CartQuote for cartitems, reached by editing a priced CartQuote
+    of the previous cart items one line at a time. previous must start with
+    lines of cartitems, in the same order, followed by any other lines.
+    """
+    quote = CartQuote(country, SERVICES)
+    for cartitem in previous:
+        quote.add_line(cartitem.id, cartitem.product, cartitem.quantity)
+    quote.costs()
+
+    wanted = dict((cartitem.id, cartitem) for cartitem in cartitems)
+    kept = 0
+    for cartitem in previous:
+        if cartitem.id in wanted:
+            quote.set_quantity(cartitem.id, wanted[cartitem.id].quantity)
+            kept += 1
+        else:
+            quote.remove_line(cartitem.id)
+
+    quote.costs()
+
+    for cartitem in cartitems[kept:]:
+        quote.add_line(cartitem.id, cartitem.product, cartitem.quantity)
+
+    return quote
+
+#
+# Case generation
+#
+
+def random_weight(rnd):
+    r = rnd.random()
+    if r < 0.4:
+        return Decimal(rnd.choice(BOUNDARY_WEIGHTS) + rnd.choice((-1, 0, 0, 1)))
+    elif r < 0.5:
+        return Decimal(rnd.randint(0, 40)) / 10
+    elif r < 0.95:
+        return Decimal(rnd.randint(1, 1500))
+    else:
+        return Decimal(rnd.randint(1990, 2100))
+
+def random_cartitems(rnd, products, first_id=0):
+    cartitems = []
+    for i in xrange(rnd.randint(0, 4)):
+        r = rnd.random()
+        if r < 0.8:
+            quantity = rnd.randint(1, 3)
+        elif r < 0.98:
+            quantity = rnd.randint(4, 12)
+        else:
+            quantity = rnd.randint(13, 40)
+        cartitems.append(CartItem(first_id + i, rnd.choice(products),
+            quantity))
+
+    return cartitems
+
+def random_case(rnd):
+    """
+    Returns (country, cart items, previous cart items); the previous cart
+    shares a prefix of lines with the cart, with some quantities changed.
+    """
+    country = Country(*rnd.choice(COUNTRIES))
+
+    products = []
+    for i in xrange(rnd.randint(1, 4)):
+        products.append(Product('p%d' % i, random_weight(rnd),
+            rnd.random() > 0.1))
+
+    if rnd.random() < 0.2:
+        # a single item at exactly a boundary weight
+        product = Product('b', Decimal(rnd.choice(BOUNDARY_WEIGHTS)))
+        cartitems = [CartItem(0, product, 1)]
+    else:
+        cartitems = random_cartitems(rnd, products)
+
+    previous = []
+    for cartitem in cartitems[:rnd.randint(0, len(cartitems))]:
+        previous.append(CartItem(cartitem.id, cartitem.product,
+            rnd.randint(1, 6)))
+    previous.extend(random_cartitems(rnd, products, first_id=100))
+
+    return country, cartitems, previous
+
+def check_case(country, cartitems, previous):
+    """
+    Returns a list of (service code, path, expected, got) differences.
+    """
+    failures = []
+    quote = incremental_quote(country, cartitems, previous)
+
+    for code in SERVICES:
+        expected = reference_quote(code, country, cartitems)
+
+        got = engine_quote(code, country, cartitems)
+        if got != expected:
+            failures.append((code, 'tiers', expected, got))
+
+        # CartQuote prices like Shipper.cost(), which also turns away carts
+        # with an item over the tier's weight limit
+        if ineligibility_for_lines(code, country, cartitems) != None:
+            expected = (None, None)
+
+        got = (quote.cost(code), quote.shipment_count(code))
+        if got != expected:
+            failures.append((code, 'quote', expected, got))
+
+    return failures
+
+def run(cases=1000, seed=0):
+    """
+    Checks cases random carts, returning a list of
+    (country, cart items, failures) for those that differ.
+    """
+    rnd = random.Random(seed)
+    failed = []
+
+    for i in xrange(cases):
+        country, cartitems, previous = random_case(rnd)
+        failures = check_case(country, cartitems, previous)
+        if failures:
+            failed.append((country, cartitems, failures))
+
+    return failed
+
+def main(argv=None):
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--cases', type='int', default=10000,
+        help='number of random carts to check')
+    parser.add_option('-s', '--seed', type='int', default=0,
+        help='random seed')
+    options, args = parser.parse_args(argv)
+
+    # oversize items are expected, don't report each one
+    logging.basicConfig(level=logging.CRITICAL)
+
+    start = time.time()
+    failed = run(options.cases, options.seed)
+    elapsed = time.time() - start
+
+    for country, cartitems, failures in failed[:20]:
+        sys.stderr.write('%r to %r:\n' % (cartitems, country))
+        for code, path, expected, got in failures:
+            sys.stderr.write('  %s (%s): expected %r, got %r\n' \
+                % (code, path, expected, got))
+
+    sys.stdout.write('%d cases, %d failed, %.0f cases/s\n' \
+        % (options.cases, len(failed), options.cases / (elapsed or 1)))
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+"""
+Precomputed costs of shipping a single item of a product, for every service
+tier and zone, so that "ships from" estimates on product pages are a cache
+lookup instead of a Shipper calculation.
+
+Each product's table is cached together with the weight and the signature of
+the rate card it was computed from; a table is rebuilt whenever either no
+longer matches, including when a new rate card takes effect.
+"""
+from django.core.cache import cache
+
+from tiers import compile_surcharges, current_rate_card, safe_get_decimal, \
+    tier_code_for_service
+from weights import grams_for_product
+
+import logging
+log = logging.getLogger('singpost.estimates')
+
+CACHE_KEY = 'singpost-estimates-%s'
+CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+def _zones(tier):
+    if tier.tiers == None and hasattr(tier, 'zones'):
+        return enumerate(tier.zones)
+
+    return ((0, tier),)
+
+def _zone_index(tier, country):
+    for index, zone in _zones(tier):
+        if zone.filter.country_is_included(country):
+            return index
+
+    return None
+
+def _cost_for_item(tier, weight):
+    """
+    Mirrors Shipper.cost() for a cart holding one shippable item.
+    """
+    if weight > tier.maximum_item_weight:
+        return None
+
+    cost = tier.cost_for_shipment_with_weight(weight)
+    if cost is None:
+        cost = tier.get_lowest_cost()
+
+    return cost
+
+def build_estimates(weight, rate_card=None):
+    """
+    Returns a dict mapping (tier code, zone index) to the cost of shipping a
+    single item of the given weight in grams, or None where it can't be
+    shipped. The current rate card is used unless another is given.
+    """
+    if rate_card is None:
+        rate_card = current_rate_card()
+
+    weight = safe_get_decimal(weight)
+
+    table = {}
+    for code, tier in rate_card.service_tiers.items():
+        if tier is None:
+            continue
+
+        for index, zone in _zones(tier):
+            table[(code, index)] = _cost_for_item(zone, weight)
+
+    return table
+
+def _entry(product, rate_card):
+    weight = grams_for_product(product)
+    return (rate_card.signature(), weight, build_estimates(weight, rate_card))
+
+def _is_current(entry, product, rate_card):
+    return entry is not None and entry[0] == rate_card.signature() \
+        and entry[1] == grams_for_product(product)
+
+def estimates_for_product(product):
+    """
+    Returns the cached table built by build_estimates() for a product,
+    rebuilding it if the product's weight or the rate card has changed.
+    """
+    rate_card = current_rate_card()
+
+    key = CACHE_KEY % product.id
+    entry = cache.get(key)
+
+    if not _is_current(entry, product, rate_card):
+        entry = _entry(product, rate_card)
+        cache.set(key, entry, CACHE_TIMEOUT)
+
+    return entry[2]
+
+def estimate_for_country(product, service_type_code, country):
+    """
+    Returns the cost of shipping a single item of product to country with
+    the given service, including any surcharge, or None if the service can't
+    be used.
+    """
+    tier_code = tier_code_for_service(service_type_code)
+    tier = current_rate_card().service_tiers.get(tier_code)
+
+    if tier is None or not tier.filter.country_is_included(country):
+        return None
+
+    index = _zone_index(tier, country)
+    if index is None:
+        return None
+
+    cost = estimates_for_product(product)[(tier_code, index)]
+    if cost is None:
+        return None
+
+    surcharges = compile_surcharges(service_type_code, country)
+    if not surcharges.rules:
+        return cost + surcharges.flat
+
+    return cost + surcharges.charge(grams_for_product(product),
+        safe_get_decimal(getattr(product, 'unit_price', 0)))
+
+def _refresh_batch(products):
+    rate_card = current_rate_card()
+
+    keys = [CACHE_KEY % product.id for product in products]
+    entries = cache.get_many(keys)
+
+    refreshed = 0
+    for key, product in zip(keys, products):
+        if _is_current(entries.get(key), product, rate_card):
+            continue
+
+        cache.set(key, _entry(product, rate_card), CACHE_TIMEOUT)
+        refreshed += 1
+
+    return refreshed
+
+def refresh_estimates(products, batch_size=500):
+    """
+    Rebuilds the cached tables of the given products whose weight or rate card
+    has changed since they were cached, reading the cache batch_size products
+    at a time. Returns the number rebuilt.
+    """
+    refreshed = 0
+    batch = []
+
+    for product in products:
+        batch.append(product)
+        if len(batch) == batch_size:
+            refreshed += _refresh_batch(batch)
+            batch = []
+
+    if batch:
+        refreshed += _refresh_batch(batch)
+
+    log.debug('refreshed estimates: refreshed=%d' % refreshed)
+    return refreshed
+
+def product_saved(sender, instance=None, **kwargs):
+    """
+    post_save handler keeping a product's table in step with its weight.
+    """
+    if instance is not None:
+        refresh_estimates((instance,))
@@ -0,0 +1,20 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+from django.core.management.base import NoArgsCommand
+from product.models import Product
+
+from ...estimates import refresh_estimates
+
+class Command(NoArgsCommand):
+    help = "Precomputes SingPost single-item estimates for every product, " \
+        "rebuilding only those whose weight or rate card has changed."
+
+    def handle_noargs(self, **options):
+        products = Product.objects.only('id', 'weight', 'weight_units').iterator()
+        refreshed = refresh_estimates(products)
+
+        print("Refreshed SingPost estimates for %d product(s)." % refreshed)
@@ -0,0 +1,54 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+import datetime
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...manifest import WRITERS, write_manifest
+
+class Command(BaseCommand):
+    help = "Writes the SingPost parcel manifest of the orders placed on a " \
+        "day (default: today)."
+    args = '[YYYY-MM-DD]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv',
+            help='Output format: %s.' % ', '.join(sorted(WRITERS.keys()))),
+        make_option('--output', dest='output', default=None,
+            help='File to write to, instead of standard output.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError('Usage: %s' % self.args)
+
+        if args:
+            try:
+                day = datetime.date(*time.strptime(args[0], '%Y-%m-%d')[:3])
+            except ValueError:
+                raise CommandError('Invalid date: %s' % args[0])
+        else:
+            day = datetime.date.today()
+
+        format = options.get('format')
+        if format not in WRITERS:
+            raise CommandError('Unknown format: %s' % format)
+
+        output = options.get('output')
+        if output:
+            out = open(output, 'wb')
+        else:
+            out = sys.stdout
+
+        try:
+            write_manifest(day, out, format=format)
+        finally:
+            if output:
+                out.close()
@@ -0,0 +1,50 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from ...profiling import stress
+from ...tiers import SERVICE_TYPE_CODES
+
+class Command(BaseCommand):
+    help = "Prices synthetic carts of up to --units units with every " \
+        "SingPost service and writes the time and peak memory of each " \
+        "stage as JSON."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--units', dest='units', type='int', default=100000,
+            help='Largest cart size, in units.'),
+        make_option('--lines', dest='lines', type='int', default=20,
+            help='Number of lines the units are spread over.'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='Random seed for product weights.'),
+        make_option('--service', dest='services', action='append',
+            default=None, help='Service to run; may be repeated. ' \
+            'Defaults to all of them.'),
+        make_option('--no-memory', dest='memory', action='store_false',
+            default=True, help='Skip memory tracing.'),
+    )
+
+    def handle(self, *args, **options):
+        services = options.get('services')
+        for code in services or ():
+            if code not in SERVICE_TYPE_CODES:
+                raise CommandError('Unknown service: %s' % code)
+
+        report = stress(max_units=options.get('units'),
+            lines=options.get('lines'), seed=options.get('seed'),
+            service_type_codes=services, memory=options.get('memory'))
+
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
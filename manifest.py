@@ -0,0 +1,201 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+"""
+Parcel manifests for fulfilment, listing the parcels each order is shipped
+in as priced at checkout.
+
+The plan kept with each order at checkout is used as is. Orders without one,
+e.g. those placed before plans were kept or whose items were changed after
+checkout, are planned again with the rate card in effect when they were
+placed.
+
+Orders are read in batches, with the items, plans and destination countries
+of a whole batch fetched in one query each, and manifest rows are written
+out as they are generated.
+"""
+try:
+    from decimal import InvalidOperation
+except:
+    from django.utils._decimal import InvalidOperation
+
+import csv
+import datetime
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from l10n.models import Country
+from satchmo_store.shop.models import Order, OrderItem
+
+from models import OrderParcelPlan
+from tiers import SERVICE_TYPE_CODES, plan_from_dict, plan_shipments, \
+    rate_card_for_date
+
+import logging
+log = logging.getLogger('singpost.manifest')
+
+MANIFEST_FIELDS = ('order', 'service', 'parcel', 'parcel_weight', 'cost',
+    'surcharge', 'sku', 'name', 'quantity')
+
+def orders_for_day(day):
+    """
+    Returns the orders placed on day (a date) to be shipped by SingPost.
+    """
+    start = datetime.datetime.combine(day, datetime.time.min)
+    end = start + datetime.timedelta(days=1)
+
+    return Order.objects.filter(time_stamp__gte=start, time_stamp__lt=end,
+        shipping_model__in=SERVICE_TYPE_CODES).order_by('id')
+
+def _stored_plan(stored, order, lines):
+    if stored is None or stored.service_type_code != order.shipping_model:
+        return None
+
+    try:
+        return plan_from_dict(json.loads(stored.plan), lines)
+    except (ValueError, KeyError, IndexError, TypeError, InvalidOperation):
+        log.warning('Invalid parcel plan stored for order: order=%s' \
+            % order.id)
+        return None
+
+def _plans_for_batch(orders, countries):
+    ids = [order.id for order in orders]
+
+    items = {}
+    for item in OrderItem.objects.filter(order__in=ids) \
+        .select_related('product').order_by('id'):
+        items.setdefault(item.order_id, []).append(item)
+
+    stored = dict([(plan.order_id, plan)
+        for plan in OrderParcelPlan.objects.filter(order__in=ids)])
+
+    plans = {}
+    missing = set()
+    for order in orders:
+        plans[order.id] = _stored_plan(stored.get(order.id), order,
+            items.get(order.id, ()))
+        if plans[order.id] is None:
+            missing.add(order.ship_country)
+
+    missing -= set(countries.keys())
+    if missing:
+        for country in Country.objects.filter(iso2_code__in=list(missing)):
+            countries[country.iso2_code] = country
+
+    for order in orders:
+        plan = plans[order.id]
+
+        country = countries.get(order.ship_country)
+        if plan is None and country is not None:
+            log.info('No parcel plan kept at checkout, planning again: ' \
+                'order=%s' % order.id)
+            plan = plan_shipments(order.shipping_model, country,
+                items.get(order.id, ()),
+                rate_card=rate_card_for_date(order.time_stamp))
+
+        if plan is None:
+            log.warning('Could not plan parcels for order: ' \
+                'order=%s, service=%s, country=%s' \
+                % (order.id, order.shipping_model, order.ship_country))
+
+        yield order, plan
+
+def plans_for_orders(orders, batch_size=200):
+    """
+    Yields (order, ParcelPlan) for each order, with a plan of None where the
+    order's service can't ship it, reading batch_size orders at a time.
+    """
+    countries = {}
+    batch = []
+
+    for order in orders.iterator():
+        batch.append(order)
+        if len(batch) == batch_size:
+            for result in _plans_for_batch(batch, countries):
+                yield result
+            batch = []
+
+    if batch:
+        for result in _plans_for_batch(batch, countries):
+            yield result
+
+def manifest_rows(plans):
+    """
+    Yields a dict with the MANIFEST_FIELDS for each product in each parcel of
+    the (order, ParcelPlan) pairs in plans.
+    """
+    for order, plan in plans:
+        if plan is None:
+            continue
+
+        for number, parcel in enumerate(plan.parcels):
+            for item, quantity in parcel.quantities():
+                yield {
+                    'order': order.id,
+                    'service': plan.service_type_code,
+                    'parcel': number + 1,
+                    'parcel_weight': str(parcel.weight),
+                    'cost': str(parcel.cost),
+                    'surcharge': str(parcel.surcharge),
+                    'sku': item.product.sku or item.product.slug,
+                    'name': item.product.name,
+                    'quantity': quantity,
+                }
+
+def _csv_value(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return value
+
+def write_csv(rows, out):
+    """
+    Writes rows from manifest_rows() to the file-like out as CSV, returning
+    the number of rows written.
+    """
+    writer = csv.writer(out)
+    writer.writerow(MANIFEST_FIELDS)
+
+    count = 0
+    for row in rows:
+        writer.writerow([_csv_value(row[field]) for field in MANIFEST_FIELDS])
+        count += 1
+
+    return count
+
+def write_json(rows, out):
+    """
+    Writes rows from manifest_rows() to the file-like out as a JSON array,
+    one row at a time, returning the number of rows written.
+    """
+    count = 0
+
+    out.write('[')
+    for row in rows:
+        if count:
+            out.write(',')
+        out.write('\n')
+        out.write(json.dumps(row))
+        count += 1
+    out.write('\n]\n')
+
+    return count
+
+WRITERS = {
+    'csv': write_csv,
+    'json': write_json,
+}
+
+def write_manifest(day, out, format='csv', batch_size=200):
+    """
+    Writes the manifest of the orders placed on day to the file-like out,
+    returning the number of rows written.
+    """
+    plans = plans_for_orders(orders_for_day(day), batch_size=batch_size)
+    return WRITERS[format](manifest_rows(plans), out)
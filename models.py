@@ -0,0 +1,48 @@
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.utils.translation import ugettext_lazy as _
+from product.models import Product
+from satchmo_store.shop.models import Order
+from satchmo_store.shop.signals import satchmo_post_copy_item_to_order
+
+from checkout import checkout_plan
+from estimates import product_saved
+from weights import forget_product_weight
+
+class OrderParcelPlan(models.Model):
+    """
+    The parcel plan an order's shipping was priced with at checkout, as
+    stored by tiers.plan_to_dict().
+    """
+    order = models.OneToOneField(Order, related_name='singpost_parcel_plan')
+    service_type_code = models.CharField(_('service'), max_length=30)
+    plan = models.TextField(_('plan'))
+
+    class Meta:
+        verbose_name = _('SingPost parcel plan')
+        verbose_name_plural = _('SingPost parcel plans')
+
+def store_checkout_plan(sender, cartitem=None, order=None, **kwargs):
+    """
+    satchmo_post_copy_item_to_order handler storing the plan the order's
+    service was priced with, when the first item of the cart is copied.
+    """
+    data = checkout_plan(sender, order.shipping_model, cartitem)
+    if data is None:
+        return
+
+    OrderParcelPlan.objects.filter(order=order).delete()
+    OrderParcelPlan.objects.create(order=order,
+        service_type_code=order.shipping_model, plan=json.dumps(data))
+
+# the cached weight must be dropped before estimates are rebuilt from it
+post_save.connect(forget_product_weight, sender=Product)
+post_delete.connect(forget_product_weight, sender=Product)
+post_save.connect(product_saved, sender=Product)
+
+satchmo_post_copy_item_to_order.connect(store_checkout_plan)
@@ -0,0 +1,346 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+"""
+Time and memory profiling of the pricing engine.
+
+Shipper.cost() is profiled while a profile_costs() block is active in the
+current thread, or on every call when the SINGPOST_PROFILING setting is on,
+in which case each call's report is logged as JSON to 'singpost.profiling'.
+
+stress() prices synthetic carts of increasing size with every service and
+reports the time and peak memory of each stage.
+
+Memory is measured in two ways. Where tracemalloc is available (Python 3.4,
+or pytracemalloc on Python 2), peak_bytes is the peak traced memory of a
+stage. tracemalloc traces the whole process, so stages measured with it run
+one at a time. Where the resource module is available, max_rss_bytes is the
+process' peak resident set size once a stage has run, which only grows when
+a stage needs more memory than anything before it.
+"""
+try:
+    from decimal import Decimal
+except:
+    from django.utils._decimal import Decimal
+
+import cProfile
+import pstats
+import random
+import sys
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from quote import CartQuote
+from synthetic import COUNTRIES, CartItem, Country, Product
+from tiers import SERVICE_TYPE_CODES, current_rate_card, plan_shipments, \
+    tier_for_service, weight_of_lines
+
+import logging
+log = logging.getLogger('singpost.profiling')
+
+# Guards the number of profiles tracing memory, and whether tracing was
+# started by them.
+_tracing_lock = threading.Lock()
+_tracing = {'profiles': 0, 'started': False}
+
+# Held while a stage is measured with tracemalloc, whose traces and peak are
+# shared by every thread.
+_measure_lock = threading.RLock()
+
+def max_rss_bytes():
+    """
+    Returns the peak resident set size of the process in bytes, or None if
+    the resource module is unavailable.
+    """
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+
+    # kilobytes elsewhere
+    return rss * 1024
+
+class Profile(object):
+    """
+    Collects the calls, time and peak memory of named stages, and optionally
+    cProfile statistics.
+
+    :param: memory: Whether to trace memory, if tracemalloc is available.
+    :param: cprofile: Whether to run stages under cProfile.
+    :param: snapshot: The number of top allocation sites to report when the
+    profile is closed, if memory is traced.
+    """
+    def __init__(self, memory=True, cprofile=False, snapshot=10):
+        self.memory = memory and tracemalloc is not None
+        self.snapshot = snapshot
+        self.stages = {}
+        self.allocations = []
+
+        self._profiler = None
+        if cprofile:
+            self._profiler = cProfile.Profile()
+        self._tracing = False
+
+    def start(self):
+        if not self.memory or self._tracing:
+            return
+
+        _tracing_lock.acquire()
+        try:
+            if _tracing['profiles'] == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracing['started'] = True
+            _tracing['profiles'] += 1
+            self._tracing = True
+        finally:
+            _tracing_lock.release()
+
+    def stop(self):
+        if not self._tracing:
+            return
+
+        _tracing_lock.acquire()
+        try:
+            if self.snapshot:
+                statistics = tracemalloc.take_snapshot().statistics('lineno')
+                self.allocations = [{
+                    'site': str(stat.traceback),
+                    'bytes': stat.size,
+                    'count': stat.count,
+                } for stat in statistics[:self.snapshot]]
+
+            # tracing is left on while other profiles still use it
+            _tracing['profiles'] -= 1
+            if _tracing['profiles'] == 0 and _tracing['started']:
+                tracemalloc.stop()
+                _tracing['started'] = False
+            self._tracing = False
+        finally:
+            _tracing_lock.release()
+
+    def run(self, stage, function, *args, **kwargs):
+        """
+        Calls function, recording it under stage, and returns its result.
+        """
+        peak = None
+        if self._tracing:
+            _measure_lock.acquire()
+            try:
+                tracemalloc.clear_traces()
+                result, elapsed = self._call(function, args, kwargs)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                _measure_lock.release()
+        else:
+            result, elapsed = self._call(function, args, kwargs)
+
+        stats = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0.0,
+            'peak_bytes': None, 'max_rss_bytes': None})
+        stats['calls'] += 1
+        stats['seconds'] += elapsed
+
+        if peak is not None and \
+            (stats['peak_bytes'] is None or peak > stats['peak_bytes']):
+            stats['peak_bytes'] = peak
+        stats['max_rss_bytes'] = max_rss_bytes()
+
+        return result
+
+    def _call(self, function, args, kwargs):
+        start = time.time()
+        if self._profiler is not None:
+            result = self._profiler.runcall(function, *args, **kwargs)
+        else:
+            result = function(*args, **kwargs)
+
+        return result, time.time() - start
+
+    def functions(self, limit=20):
+        """
+        Returns the cProfile statistics of the limit functions with the most
+        cumulative time.
+        """
+        if self._profiler is None:
+            return []
+
+        stats = pstats.Stats(self._profiler)
+        rows = []
+        for (filename, line, name), (cc, nc, tt, ct, callers) in \
+            stats.stats.items():
+            rows.append({
+                'function': '%s:%d(%s)' % (filename, line, name),
+                'calls': nc,
+                'seconds': tt,
+                'cumulative_seconds': ct,
+            })
+
+        rows.sort(key=lambda row: row['cumulative_seconds'], reverse=True)
+        return rows[:limit]
+
+    def report(self):
+        return {
+            'stages': self.stages,
+            'allocations': self.allocations,
+            'functions': self.functions(),
+        }
+
+_local = threading.local()
+
+def current_profile():
+    """
+    Returns the Profile of the innermost active profile_costs() block in this
+    thread, or None.
+    """
+    profiles = getattr(_local, 'profiles', None)
+    if profiles:
+        return profiles[-1]
+
+    return None
+
+class profile_costs(object):
+    """
+    A context manager profiling Shipper.cost() in the current thread:
+
+        with profile_costs(cprofile=True) as profile:
+            shipper.cost()
+        print profile.report()
+    """
+    def __init__(self, **kwargs):
+        self.profile = Profile(**kwargs)
+
+    def __enter__(self):
+        if not hasattr(_local, 'profiles'):
+            _local.profiles = []
+
+        _local.profiles.append(self.profile)
+        self.profile.start()
+        return self.profile
+
+    def __exit__(self, *exc_info):
+        self.profile.stop()
+        _local.profiles.remove(self.profile)
+        return False
+
+def profile_call(stage, function, *args, **kwargs):
+    """
+    Calls function under a new Profile and logs its report as JSON.
+    """
+    profile = Profile(snapshot=0)
+    profile.start()
+    try:
+        return profile.run(stage, function, *args, **kwargs)
+    finally:
+        profile.stop()
+        log.info(json.dumps(profile.report()))
+
+#
+# Stress testing
+#
+
+STRESS_SIZES = (10, 100, 1000, 10000, 100000)
+
+def synthetic_cart(units, lines, rnd):
+    """
+    Returns cart items with units units in total, spread over lines products
+    of random weights.
+    """
+    lines = max(1, min(lines, units))
+    cartitems = []
+
+    remaining = units
+    for i in xrange(lines):
+        if i == lines - 1:
+            quantity = remaining
+        else:
+            quantity = max(1, remaining // (lines - i))
+        remaining -= quantity
+
+        product = Product('p%d' % i, Decimal(rnd.randint(1, 1500)))
+        cartitems.append(CartItem(i, product, quantity))
+
+    return cartitems
+
+def _partition(tier, cartitems):
+    return tier.partitioned_lines(weight_of_lines(cartitems), cartitems)
+
+def _quote(country, code, cartitems):
+    quote = CartQuote(country, (code,))
+    for cartitem in cartitems:
+        quote.add_line(cartitem.id, cartitem.product, cartitem.quantity)
+
+    return quote.cost(code)
+
+def stress(max_units=100000, lines=20, seed=0, service_type_codes=None,
+    memory=True):
+    """
+    Prices synthetic carts of STRESS_SIZES units, up to max_units, with every
+    service to a destination in each of its zones, and returns a report of the
+    time and peak memory of each stage: weighing the cart, partitioning it,
+    planning and pricing the parcels, and quoting it with a CartQuote.
+    """
+    rnd = random.Random(seed)
+    codes = service_type_codes or SERVICE_TYPE_CODES
+    countries = [Country(*country) for country in COUNTRIES]
+
+    runs = []
+    for units in [size for size in STRESS_SIZES if size <= max_units]:
+        cartitems = synthetic_cart(units, lines, rnd)
+
+        for code in codes:
+            # one destination for each tier or zone the service uses
+            tiers_seen = set()
+            for country in countries:
+                tier = tier_for_service(code, country)
+                if tier is None or id(tier) in tiers_seen:
+                    continue
+                tiers_seen.add(id(tier))
+
+                profile = Profile(memory=memory, snapshot=0)
+                profile.start()
+                try:
+                    profile.run('weight', weight_of_lines, cartitems)
+                    parcels = profile.run('partition', _partition, tier,
+                        cartitems)
+                    plan = profile.run('plan', plan_shipments, code, country,
+                        cartitems)
+                    profile.run('quote', _quote, country, code, cartitems)
+                finally:
+                    profile.stop()
+
+                runs.append({
+                    'units': units,
+                    'lines': len(cartitems),
+                    'service': code,
+                    'country': country.iso2_code,
+                    'parcels': len(parcels or ()),
+                    'cost': str(plan.cost) if plan else None,
+                    'stages': profile.stages,
+                })
+
+    return {
+        'rate_card': current_rate_card().signature(),
+        'seed': seed,
+        'memory_traced': memory and tracemalloc is not None,
+        'max_rss_bytes': max_rss_bytes(),
+        'runs': runs,
+    }
@@ -0,0 +1,199 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+"""
+Rate providers, quoting every service of a carrier for many carts and
+destinations at once, and compare_rates(), which fans several providers out
+over a thread pool to compare their rates.
+
+A provider keeps no state between calls and quote_many() mutates nothing
+shared, so one provider can serve several threads. SingPostRateProvider
+prices with the engine in tiers directly and never builds a Shipper, whose
+calculate() rebinds its cart and contact.
+"""
+from multiprocessing.pool import ThreadPool
+
+from tiers import SERVICE_TYPE_CODES, current_rate_card, \
+    ineligibility_for_lines, plan_shipments
+
+import logging
+log = logging.getLogger('singpost.provider')
+
+def lines_of(cart):
+    """
+    Returns the lines of a cart as a list, reading a Satchmo Cart's items
+    once. Anything else is taken to be an iterable of lines already.
+    """
+    if hasattr(cart, 'cartitem_set'):
+        return list(cart.cartitem_set.select_related('product'))
+
+    return list(cart)
+
+class RateQuote(object):
+    """
+    The rate of one service of a carrier for shipping a cart to a
+    destination.
+
+    :param: cost: The cost, or None if the service can't price the cart,
+    e.g. if nothing in it is shippable.
+    :param: plan: The ParcelPlan, for providers that plan parcels.
+    :param: ineligibility: None if the service can ship the cart, or the
+    reason it can't.
+    """
+    def __init__(self, carrier, service_type_code, cart, destination, cost,
+        plan=None, ineligibility=None):
+        self.carrier = carrier
+        self.service_type_code = service_type_code
+        self.cart = cart
+        self.destination = destination
+        self.cost = cost
+        self.plan = plan
+        self.ineligibility = ineligibility
+
+    def __repr__(self):
+        return '<RateQuote %s %s: %s>' % (self.carrier,
+            self.service_type_code, self.cost)
+
+    def _get_valid(self):
+        return self.ineligibility == None
+    valid = property(_get_valid)
+
+class RateProvider(object):
+    """
+    Quotes the services of a carrier. Subclasses implement quote(), and may
+    override quote_many() where carts can be priced in bulk.
+    """
+    carrier = None
+
+    def quote(self, cart, lines, destination):
+        """
+        Returns a RateQuote for each service, for shipping lines (those of
+        cart) to destination (a Country).
+        """
+        raise NotImplementedError
+
+    def quote_many(self, carts, destinations):
+        """
+        Returns, for each cart and then each destination, the list of
+        RateQuotes of every service.
+        """
+        results = []
+        for cart in carts:
+            lines = lines_of(cart)
+            for destination in destinations:
+                results.append(self.quote(cart, lines, destination))
+
+        return results
+
+class SingPostRateProvider(RateProvider):
+    """
+    Quotes SingPost services with the pricing engine.
+
+    :param: service_type_codes: The services to quote, by default all of
+    them.
+    :param: rate_card: The rate card to price with. By default, each call
+    to quote_many() uses the card in effect when it is made.
+    """
+    carrier = 'singpost'
+
+    def __init__(self, service_type_codes=None, rate_card=None):
+        self.service_type_codes = tuple(service_type_codes or
+            SERVICE_TYPE_CODES)
+        self.rate_card = rate_card
+
+    def _quote(self, cart, lines, destination, rate_card):
+        quotes = []
+        for code in self.service_type_codes:
+            ineligibility = ineligibility_for_lines(code, destination, lines,
+                rate_card)
+
+            plan = None
+            if ineligibility == None:
+                plan = plan_shipments(code, destination, lines, rate_card)
+
+            cost = None
+            if plan != None:
+                cost = plan.cost
+
+            quotes.append(RateQuote(self.carrier, code, cart, destination,
+                cost, plan, ineligibility))
+
+        return quotes
+
+    def quote(self, cart, lines, destination):
+        return self._quote(cart, lines, destination,
+            self.rate_card or current_rate_card())
+
+    def quote_many(self, carts, destinations):
+        # one card for the whole call, even across a cutover
+        rate_card = self.rate_card or current_rate_card()
+
+        results = []
+        for cart in carts:
+            lines = lines_of(cart)
+            for destination in destinations:
+                results.append(self._quote(cart, lines, destination,
+                    rate_card))
+
+        return results
+
+def _quote_many(args):
+    provider, lines, destinations = args
+    try:
+        return provider.quote_many([lines], destinations)
+    except Exception:
+        log.exception('Rate provider failed: carrier=%s' % provider.carrier)
+        return None
+
+def compare_rates(providers, carts, destinations, threads=4, pool=None):
+    """
+    Quotes carts to destinations with every provider, each cart with each
+    provider in a thread of a pool, and returns, for each cart and then each
+    destination, the valid and priced RateQuotes of all the providers,
+    cheapest first.
+
+    The lines of each cart are read once, in the calling thread, and shared
+    by the providers. A provider that raises is logged and left out.
+
+    :param: pool: A ThreadPool to use; otherwise one of threads threads is
+    made for the call.
+    """
+    carts = list(carts)
+    lines = [lines_of(cart) for cart in carts]
+    destinations = list(destinations)
+
+    tasks = []
+    for provider in providers:
+        for index in xrange(len(carts)):
+            tasks.append((index, (provider, lines[index], destinations)))
+
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPool(threads)
+
+    try:
+        results = pool.map(_quote_many, [task for index, task in tasks])
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    comparison = [[] for i in xrange(len(carts) * len(destinations))]
+    for (index, task), result in zip(tasks, results):
+        if result is None:
+            continue
+
+        for i, quotes in enumerate(result):
+            for quote in quotes:
+                if quote.valid and quote.cost is not None:
+                    # providers were given the lines, not the cart
+                    quote.cart = carts[index]
+                    comparison[index * len(destinations) + i].append(quote)
+
+    for quotes in comparison:
+        quotes.sort(key=lambda quote: quote.cost)
+
+    return comparison
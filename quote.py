@@ -0,0 +1,364 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+"""
+Incremental quoting of a cart that changes one line at a time.
+
+A CartQuote keeps, for every cost tier in use, the parcels produced by each
+cart line together with the partitioning state the line started from. When a
+line is added, removed or has its quantity changed, lines before it are
+reused as they are, and lines after it are reused as soon as the state they
+start from is the same as before, so only the parcels around the change are
+partitioned and priced again.
+
+The partitioning replicates partitioned_lines() and Shipper.cost() exactly,
+including the check that no item is heavier than a service takes, so
+CartQuote.cost() always equals Shipper.cost() for the same cart.
+
+A quote can be kept between requests and brought up to date with
+update_from_cart(), which only touches the lines that changed. It prices
+the cart but doesn't keep the ParcelPlan; Shipper.parcel_plan() still
+makes the plan stored with an order.
+"""
+try:
+    from decimal import Decimal
+except:
+    from django.utils._decimal import Decimal
+
+from tiers import compile_surcharges, current_rate_card, safe_get_decimal, \
+    tier_for_service
+from weights import grams_for_product
+
+ZERO = Decimal(0)
+
+# (weight of the open shipment, shippable weight of the open shipment,
+#  value of the open shipment, whether the open shipment holds any items)
+INITIAL_STATE = (ZERO, ZERO, ZERO, False)
+
+class _Line(object):
+    def __init__(self, key, product, quantity, unit_price=None):
+        self.key = key
+        self.product = product
+        self.quantity = quantity
+        self.value = safe_get_decimal(unit_price or 0)
+
+        self.weight = grams_for_product(product)
+        if product.is_shippable:
+            self.shippable_weight = self.weight
+        else:
+            self.shippable_weight = ZERO
+
+class _Segment(object):
+    """
+    The shipments closed while partitioning one line, starting from state,
+    as (shippable weight, value) pairs. parcels is None if the line could
+    not be partitioned.
+    """
+    def __init__(self, state, end_state, parcels, cost):
+        self.state = state
+        self.end_state = end_state
+        self.parcels = parcels
+        self.cost = cost
+
+def _partition_line(line, state, maximum_item_weight):
+    the_weight, shippable_weight, value, has_items = state
+    parcels = []
+
+    for i in xrange(line.quantity):
+        new_weight = the_weight + line.weight
+
+        if new_weight <= maximum_item_weight:
+            the_weight = new_weight
+            shippable_weight += line.shippable_weight
+            value += line.value
+            has_items = True
+
+            if new_weight == maximum_item_weight:
+                parcels.append((shippable_weight, value))
+                shippable_weight = ZERO
+                value = ZERO
+                has_items = False
+        elif has_items and the_weight > ZERO:
+            parcels.append((shippable_weight, value))
+            the_weight = line.weight
+            shippable_weight = line.shippable_weight
+            value = line.value
+        else:
+            return None, state
+
+    return parcels, (the_weight, shippable_weight, value, has_items)
+
+class _TierPlan(object):
+    """
+    The parcels of a cart for one cost tier, kept per line.
+    """
+    def __init__(self, tier):
+        self.tier = tier
+        self.segments = []
+        self._costs = {}
+
+    def cost_for_parcel(self, weight):
+        cost = self._costs.get(weight)
+        if cost is None:
+            cost = self.tier.cost_for_shipment_with_weight(weight)
+
+            # use the lightest class
+            if cost is None:
+                cost = self.tier.get_lowest_cost()
+
+            self._costs[weight] = cost
+
+        return cost
+
+    def _segment(self, line, state):
+        parcels, end_state = _partition_line(line, state,
+            self.tier.maximum_item_weight)
+        if parcels is None:
+            return _Segment(state, end_state, None, None)
+
+        cost = ZERO
+        for weight, value in parcels:
+            cost += self.cost_for_parcel(weight)
+
+        return _Segment(state, end_state, parcels, cost)
+
+    def insert(self, index):
+        self.segments.insert(index, None)
+
+    def remove(self, index):
+        del self.segments[index]
+
+    def invalidate(self, index):
+        self.segments[index] = None
+
+    def update(self, lines, parcels=None):
+        """
+        Brings the segments up to date with lines, returning
+        (shipment count, cost of shipments) or None if the cart can't be
+        partitioned. If parcels is a list, the (shippable weight, value) of
+        every shipment is appended to it.
+        """
+        state = INITIAL_STATE
+        count = 0
+        cost = ZERO
+
+        for index, line in enumerate(lines):
+            segment = self.segments[index]
+            if segment is None or segment.state != state:
+                segment = self._segment(line, state)
+                self.segments[index] = segment
+
+            if segment.parcels is None:
+                return None
+
+            count += len(segment.parcels)
+            cost += segment.cost
+            state = segment.end_state
+
+            if parcels is not None:
+                parcels.extend(segment.parcels)
+
+        if state[3]:
+            count += 1
+            cost += self.cost_for_parcel(state[1])
+
+            if parcels is not None:
+                parcels.append((state[1], state[2]))
+
+        return count, cost
+
+class CartQuote(object):
+    """
+    Quotes a cart to a single destination for several services, updating the
+    quotes incrementally as lines change.
+
+    :param: country: The destination country.
+    :param: service_type_codes: Codes of the services to quote, as used by
+    Shipper.
+    :param: rate_card: The RateCard to quote with, by default the current one.
+    """
+    def __init__(self, country, service_type_codes, rate_card=None):
+        self.country = country
+        self.service_type_codes = tuple(service_type_codes)
+        self.rate_card = rate_card or current_rate_card()
+
+        self.lines = []
+        self.total_weight = ZERO
+        self.total_value = ZERO
+        self._heaviest = None
+
+        self._tiers = {}
+        self._plans = {}
+        for code in self.service_type_codes:
+            tier = tier_for_service(code, country, self.rate_card)
+            self._tiers[code] = tier
+
+            if tier is not None and id(tier) not in self._plans:
+                self._plans[id(tier)] = _TierPlan(tier)
+
+    @classmethod
+    def from_cart(cls, cart, contact, service_type_codes):
+        quote = cls(contact.shipping_address.country, service_type_codes)
+        quote.update_from_cart(cart)
+
+        return quote
+
+    def update_from_cart(self, cart):
+        """
+        Brings the lines up to date with the items of a Satchmo cart, keyed
+        by cart item id as from_cart() does. Lines of items no longer in the
+        cart are removed, changed quantities are set and new items are
+        added, so only the parcels around the changes are priced again.
+
+        The weight and price of a product are read when its line is added;
+        a line whose product changed must be removed and added again.
+        """
+        cartitems = list(cart.cartitem_set.select_related('product'))
+        wanted = dict((cartitem.id, cartitem) for cartitem in cartitems)
+
+        for line in list(self.lines):
+            if line.key not in wanted:
+                self.remove_line(line.key)
+
+        keys = [line.key for line in self.lines]
+        if keys != [cartitem.id for cartitem in cartitems[:len(keys)]]:
+            # the cart's lines were reordered; start over
+            for key in keys:
+                self.remove_line(key)
+            keys = []
+
+        quantities = dict((line.key, line.quantity) for line in self.lines)
+        for cartitem in cartitems[:len(keys)]:
+            if quantities[cartitem.id] != cartitem.quantity:
+                self.set_quantity(cartitem.id, cartitem.quantity)
+
+        for cartitem in cartitems[len(keys):]:
+            self.add_line(cartitem.id, cartitem.product, cartitem.quantity,
+                cartitem.unit_price)
+
+    def _index(self, key):
+        for index, line in enumerate(self.lines):
+            if line.key == key:
+                return index
+
+        raise KeyError(key)
+
+    def add_line(self, key, product, quantity, unit_price=None):
+        """
+        Appends a line. unit_price is only needed for surcharges that depend
+        on the value of a shipment.
+        """
+        line = _Line(key, product, quantity, unit_price)
+        self.lines.append(line)
+        self.total_weight += line.shippable_weight * quantity
+        self.total_value += line.value * quantity
+        self._heaviest = None
+
+        for plan in self._plans.values():
+            plan.insert(len(self.lines) - 1)
+
+    def remove_line(self, key):
+        index = self._index(key)
+        line = self.lines.pop(index)
+        self.total_weight -= line.shippable_weight * line.quantity
+        self.total_value -= line.value * line.quantity
+        self._heaviest = None
+
+        for plan in self._plans.values():
+            plan.remove(index)
+
+    def set_quantity(self, key, quantity):
+        if quantity <= 0:
+            self.remove_line(key)
+            return
+
+        index = self._index(key)
+        line = self.lines[index]
+        self.total_weight += line.shippable_weight * (quantity - line.quantity)
+        self.total_value += line.value * (quantity - line.quantity)
+        line.quantity = quantity
+
+        for plan in self._plans.values():
+            plan.invalidate(index)
+
+    def _heaviest_weight(self):
+        if self._heaviest is None:
+            self._heaviest = ZERO
+            for line in self.lines:
+                if line.shippable_weight > self._heaviest:
+                    self._heaviest = line.shippable_weight
+
+        return self._heaviest
+
+    def _shipments(self, service_type_code, parcels=None):
+        tier = self._tiers[service_type_code]
+        if tier is None:
+            return None
+
+        # as ineligibility_for_lines()
+        if self._heaviest_weight() > tier.maximum_item_weight:
+            return None
+
+        plan = self._plans[id(tier)]
+
+        if self.total_weight < tier.maximum_item_weight:
+            # everything fits in one shipment
+            if not [line for line in self.lines if line.quantity]:
+                return None
+
+            if parcels is not None:
+                parcels.append((self.total_weight, self.total_value))
+            return 1, plan.cost_for_parcel(self.total_weight)
+
+        result = plan.update(self.lines, parcels)
+        if result is None or not result[0]:
+            return None
+
+        return result
+
+    def shipment_count(self, service_type_code):
+        """
+        Returns the number of shipments the cart is split into, or None if
+        the service can't be used.
+        """
+        result = self._shipments(service_type_code)
+        if result is None:
+            return None
+
+        return result[0]
+
+    def cost(self, service_type_code):
+        """
+        Returns the same value as Shipper.cost() for the current lines.
+        """
+        surcharges = compile_surcharges(service_type_code, self.country,
+            self.rate_card)
+
+        if not surcharges.rules:
+            result = self._shipments(service_type_code)
+            if result is None:
+                return None
+
+            count, cost = result
+            return cost + count * surcharges.flat
+
+        parcels = []
+        result = self._shipments(service_type_code, parcels)
+        if result is None:
+            return None
+
+        cost = result[1]
+        for surcharge in surcharges.charges(parcels):
+            cost += surcharge
+
+        return cost
+
+    def costs(self):
+        """
+        Returns a dict mapping each service code to its cost().
+        """
+        return dict((code, self.cost(code))
+            for code in self.service_type_codes)
@@ -0,0 +1,44 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+"""
+Plain stand-ins for the countries, products and cart items the engine
+prices, for pricing carts without Django, as the differential harness and
+the stress test do.
+"""
+
+# (iso2_code, continent) of destinations covering every filter and zone
+COUNTRIES = (
+    ('SG', 'AS'), ('MY', 'AS'), ('BN', 'AS'), ('TH', 'AS'), ('CN', 'AS'),
+    ('JO', 'AS'), ('AS', 'OC'), ('AU', 'OC'), ('GB', 'EU'), ('US', 'NA'),
+)
+
+class Country(object):
+    def __init__(self, iso2_code, continent):
+        self.iso2_code = iso2_code
+        self.continent = continent
+
+    def __repr__(self):
+        return self.iso2_code
+
+class Product(object):
+    def __init__(self, name, weight, is_shippable=True):
+        self.name = name
+        self.weight = weight
+        self.is_shippable = is_shippable
+
+    def __repr__(self):
+        return '%s(%s%s)' % (self.name, self.weight,
+            '' if self.is_shippable else ', not shippable')
+
+class CartItem(object):
+    def __init__(self, id, product, quantity):
+        self.id = id
+        self.product = product
+        self.quantity = quantity
+
+    def __repr__(self):
+        return '%rx%d' % (self.product, self.quantity)
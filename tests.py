@@ -5,16 +5,38 @@ Copyright (C) 2009-2010, Tay Ray Chuan
 Please see LICENCE for licensing details.
 """
 
+import csv
+import datetime
+import threading
 import unittest
+from StringIO import StringIO
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
 
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.sites.models import Site
 from l10n.models import Country
 from satchmo_store.contact.models import Contact
-from satchmo_store.shop.models import Cart
+from satchmo_store.shop.models import Cart, Order
+from payment.utils import update_orderitems
 from product.models import Product
 
-from shipper import Shipper as singpost
+from shipper import Shipper as singpost, shippers_by_cost, cheapest_shipper, \
+    INELIGIBLE_DESTINATION, INELIGIBLE_ITEM_WEIGHT
+from estimates import estimate_for_country, estimates_for_product, \
+    refresh_estimates
+from quote import CartQuote
+import differential
+from weights import grams_for_product
+import manifest
+from models import OrderParcelPlan
+import profiling
+import shipper as shipper_module
+from provider import SingPostRateProvider, compare_rates
+import tiers
 
 try:
     from decimal import Decimal
@@ -223,6 +245,35 @@ class LocalShippingTestCase(BaseTestCase):
         self.assertEqual(ship1._weight(), Decimal('1.6'))
         self.assertEqual(ship1.cost(), Decimal('0.50'))
 
+    def test_weight_units(self):
+        p1 = Product.objects.create(
+            site=self.site,
+            name='Shoulder Blouse (kg)',
+            slug='shoulder-blouse-kg',
+            items_in_stock=10,
+            weight='0.35', weight_units='kg')
+        p2 = Product.objects.create(
+            site=self.site,
+            name='Shoulder Blouse (g)',
+            slug='shoulder-blouse-g',
+            items_in_stock=10,
+            weight='350', weight_units='gms')
+
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(p1, 9)
+        ship1 = singpost(cart=cart1, service_type=('LOCAL',''), contact=self.contact_sg)
+        self.assertEqual(ship1._weight(), Decimal('3150'))
+
+        cart2 = Cart.objects.create(site=self.site)
+        cart2.add_item(p2, 9)
+        ship2 = singpost(cart=cart2, service_type=('LOCAL',''), contact=self.contact_sg)
+        self.assertEqual(ship1.cost(), ship2.cost())
+
+        p1.weight = '0.8'
+        p1.weight_units = 'lb'
+        p1.save()
+        self.assertEqual(grams_for_product(p1), Decimal('362.873896'))
+
     def test_partitioned_shipping(self):
         p1 = self.product_blouse
         p2 = self.product_skirt
@@ -258,6 +309,8 @@ class LocalShippingTestCase(BaseTestCase):
         self.assertTrue(cart3.is_shippable)
         self.assertEqual(ship3._weight(), Decimal('2001'))
         self.assertEqual(ship3.cost(), None)
+        self.assertEqual(ship3.valid(), False)
+        self.assertEqual(ship3.ineligibility(), INELIGIBLE_ITEM_WEIGHT)
 
     def test_country_filter(self):
         p1 = self.product_blouse
@@ -271,6 +324,7 @@ class LocalShippingTestCase(BaseTestCase):
         ship2 = singpost(cart=cart1, service_type=('LOCAL',''), contact=self.contact_my)
         self.assertEqual(ship2.cost(), None)
         self.assertEqual(ship2.valid(), False)
+        self.assertEqual(ship2.ineligibility(), INELIGIBLE_DESTINATION)
 
 class SurfaceTestCase(BaseTestCase):
     def test_shipping1(self):
@@ -378,3 +432,587 @@ class AirTestCase(BaseTestCase):
         self.assertTrue(cart2.is_shippable)
         self.assertEqual(ship2._weight(), Decimal('42'))
         self.assertEqual(ship2.cost(), Decimal('2.15'))
+
+class CheapestServiceTestCase(BaseTestCase):
+    SERVICES = ('LOCAL', 'LOCAL_REGISTERED', 'SURFACE', 'SURFACE_REGISTERED',
+        'AIR', 'AIR_REGISTERED')
+
+    def _shippers(self, cart, contact):
+        return [singpost(cart=cart, service_type=(code, ''), contact=contact)
+            for code in self.SERVICES]
+
+    def _exhaustive(self, shippers):
+        costs = [(s.cost(), i, s) for i, s in enumerate(shippers)]
+        return [(c, s) for c, i, s in sorted(costs) if c is not None]
+
+    def test_matches_exhaustive(self):
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(self.product_blouse, 9)
+        cart1.add_item(self.product_dress, 3)
+
+        for contact in (self.contact_sg, self.contact_my, self.contact_th,
+            self.contact_as, self.contact_au):
+            shippers = self._shippers(cart1, contact)
+            expected = self._exhaustive(shippers)
+
+            self.assertEqual(list(shippers_by_cost(shippers)), expected)
+            self.assertEqual(cheapest_shipper(shippers), expected[0])
+
+    def test_lower_bound(self):
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(self.product_blouse, 9)
+
+        for shipper in self._shippers(cart1, self.contact_sg):
+            cost = shipper.cost()
+            if cost is None:
+                continue
+            self.assertTrue(shipper.cost_lower_bound() <= cost)
+
+    def test_ineligible_service(self):
+        # the heavy item is after a light one, so it could be partitioned
+        # into a parcel of its own, but it is over LOCAL's maximum weight
+        p1 = Product.objects.create(
+            site=self.site,
+            name='Feather',
+            slug='feather',
+            items_in_stock=10,
+            weight='1', weight_units='gms')
+        p2 = Product.objects.create(
+            site=self.site,
+            name='Safe',
+            slug='safe',
+            items_in_stock=10,
+            weight='5000', weight_units='gms')
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(p1, 1)
+        cart1.add_item(p2, 1)
+
+        shippers = self._shippers(cart1, self.contact_sg)
+        for shipper in shippers:
+            if not shipper.valid():
+                self.assertEqual(shipper.cost(), None)
+                self.assertEqual(shipper.cost_lower_bound(), None)
+
+        self.assertEqual(shippers[0].ineligibility(), INELIGIBLE_ITEM_WEIGHT)
+
+        expected = self._exhaustive(shippers)
+        self.assertEqual(list(shippers_by_cost(shippers)), expected)
+        for cost, shipper in expected:
+            self.assertTrue(shipper.valid())
+            self.assertTrue(shipper.cost_lower_bound() <= cost)
+
+    def test_no_valid_service(self):
+        p1 = Product.objects.create(
+            site=self.site,
+            name='Anvil',
+            slug='anvil',
+            items_in_stock=10,
+            weight='2001', weight_units='gms')
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(p1, 1)
+
+        shippers = [singpost(cart=cart1, service_type=('LOCAL',''),
+            contact=self.contact_sg)]
+        self.assertEqual(list(shippers_by_cost(shippers)), [])
+        self.assertEqual(cheapest_shipper(shippers), None)
+
+class EstimatesTestCase(BaseTestCase):
+    def test_matches_shipper(self):
+        for product in (self.product_blouse, self.product_dress,
+            self.product_skirt):
+            cart1 = Cart.objects.create(site=self.site)
+            cart1.add_item(product, 1)
+
+            for contact in (self.contact_sg, self.contact_my, self.contact_th,
+                self.contact_as, self.contact_au):
+                country = contact.shipping_address.country
+
+                for code in ('LOCAL', 'LOCAL_REGISTERED', 'SURFACE',
+                    'SURFACE_REGISTERED', 'AIR', 'AIR_REGISTERED'):
+                    ship1 = singpost(cart=cart1, service_type=(code, ''),
+                        contact=contact)
+                    self.assertEqual(
+                        estimate_for_country(product, code, country),
+                        ship1.cost())
+
+    def test_refresh(self):
+        product = self.product_skirt
+        refresh_estimates((product,))
+        self.assertEqual(refresh_estimates((product,)), 0)
+
+        product.weight = '2500'
+        self.assertEqual(refresh_estimates((product,)), 1)
+        self.assertEqual(estimates_for_product(product)[('LOCAL', 0)], None)
+
+class CartQuoteTestCase(BaseTestCase):
+    SERVICES = ('LOCAL', 'LOCAL_REGISTERED', 'SURFACE', 'SURFACE_REGISTERED',
+        'AIR', 'AIR_REGISTERED')
+
+    def _assert_matches(self, quote, lines, contact):
+        cart1 = Cart.objects.create(site=self.site)
+        for product, quantity in lines:
+            cart1.add_item(product, quantity)
+
+        for code in self.SERVICES:
+            ship1 = singpost(cart=cart1, service_type=(code, ''),
+                contact=contact)
+            self.assertEqual(quote.cost(code), ship1.cost())
+
+    def test_deltas(self):
+        for contact in (self.contact_sg, self.contact_my, self.contact_au):
+            quote = CartQuote(contact.shipping_address.country, self.SERVICES)
+            self._assert_matches(quote, (), contact)
+
+            quote.add_line('blouse', self.product_blouse, 1)
+            self._assert_matches(quote, ((self.product_blouse, 1),), contact)
+
+            quote.add_line('skirt', self.product_skirt, 10)
+            quote.set_quantity('blouse', 9)
+            self._assert_matches(quote, ((self.product_blouse, 9),
+                (self.product_skirt, 10)), contact)
+
+            quote.add_line('dress', self.product_dress, 4)
+            quote.set_quantity('skirt', 3)
+            self._assert_matches(quote, ((self.product_blouse, 9),
+                (self.product_skirt, 3), (self.product_dress, 4)), contact)
+
+            quote.remove_line('blouse')
+            self._assert_matches(quote, ((self.product_skirt, 3),
+                (self.product_dress, 4)), contact)
+
+            quote.set_quantity('skirt', 0)
+            self._assert_matches(quote, ((self.product_dress, 4),), contact)
+
+    def test_from_cart(self):
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(self.product_blouse, 9)
+        cart1.add_item(self.product_skirt, 10)
+
+        quote = CartQuote.from_cart(cart1, self.contact_sg, self.SERVICES)
+        self.assertEqual(quote.cost('LOCAL'), Decimal('7.70'))
+
+    def test_update_from_cart(self):
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(self.product_blouse, 9)
+        cart1.add_item(self.product_skirt, 10)
+        quote = CartQuote.from_cart(cart1, self.contact_sg, self.SERVICES)
+
+        # the next request: the cart changed in between
+        cart1.add_item(self.product_dress, 4)
+        cart1.add_item(self.product_skirt, 2)
+        blouse = cart1.cartitem_set.get(product=self.product_blouse)
+        cart1.remove_item(blouse.id, 9)
+        quote.update_from_cart(cart1)
+
+        self.assertEqual([line.key for line in quote.lines],
+            [cartitem.id for cartitem in cart1.cartitem_set.all()])
+        for code in self.SERVICES:
+            ship1 = singpost(cart=cart1, service_type=(code, ''),
+                contact=self.contact_sg)
+            self.assertEqual(quote.cost(code), ship1.cost())
+
+    def test_ineligible(self):
+        feather = Product.objects.create(site=self.site, name='Feather',
+            slug='light-feather', items_in_stock=10, weight='1',
+            weight_units='gms')
+        safe = Product.objects.create(site=self.site, name='Safe',
+            slug='heavy-safe', items_in_stock=10, weight='5000',
+            weight_units='gms')
+
+        quote = CartQuote(self.contact_sg.shipping_address.country,
+            self.SERVICES)
+        quote.add_line('feather', feather, 1)
+        quote.add_line('safe', safe, 1)
+        self._assert_matches(quote, ((feather, 1), (safe, 1)),
+            self.contact_sg)
+        self.assertEqual(quote.cost('LOCAL'), None)
+
+        quote.remove_line('safe')
+        self.assertNotEqual(quote.cost('LOCAL'), None)
+
+class DifferentialTestCase(unittest.TestCase):
+    def test_random_carts(self):
+        failed = differential.run(cases=500, seed=2010)
+        self.assertEqual(failed, [])
+
+    def test_boundary_weights(self):
+        for weight in differential.BOUNDARY_WEIGHTS:
+            for quantity in (1, 2, 3):
+                product = differential.Product('b', Decimal(weight))
+                cartitems = [differential.CartItem(0, product, quantity)]
+
+                for iso2_code, continent in differential.COUNTRIES:
+                    country = differential.Country(iso2_code, continent)
+                    self.assertEqual(
+                        differential.check_case(country, cartitems, []), [])
+
+class ParcelPlanTestCase(BaseTestCase):
+    def test_partitioned_plan(self):
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(self.product_blouse, 9)
+        cart1.add_item(self.product_skirt, 10)
+        ship1 = singpost(cart=cart1, service_type=('LOCAL_REGISTERED',''),
+            contact=self.contact_sg)
+
+        plan = ship1.parcel_plan()
+        self.assertEqual([p.weight for p in plan.parcels],
+            [Decimal('1890'), Decimal('1980'), Decimal('115')])
+        self.assertEqual([p.cost for p in plan.parcels],
+            [Decimal('3.35'), Decimal('3.35'), Decimal('1.00')])
+        self.assertEqual([p.surcharge for p in plan.parcels],
+            [Decimal('2.24')] * 3)
+        self.assertEqual(plan.cost, ship1.cost())
+
+        quantities = [[(item.product, quantity)
+            for item, quantity in p.quantities()] for p in plan.parcels]
+        self.assertEqual(quantities, [
+            [(self.product_blouse, 6)],
+            [(self.product_blouse, 3), (self.product_skirt, 9)],
+            [(self.product_skirt, 1)],
+        ])
+
+    def test_manifest(self):
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(self.product_blouse, 9)
+        ship1 = singpost(cart=cart1, service_type=('LOCAL',''),
+            contact=self.contact_sg)
+
+        class Order(object):
+            id = 1
+
+        out = StringIO()
+        count = manifest.write_csv(
+            manifest.manifest_rows([(Order(), ship1.parcel_plan())]), out)
+        self.assertEqual(count, 2)
+
+        rows = list(csv.reader(StringIO(out.getvalue())))
+        self.assertEqual(tuple(rows[0]), manifest.MANIFEST_FIELDS)
+        self.assertEqual([(row[2], Decimal(row[3]), Decimal(row[4]), row[8])
+            for row in rows[1:]], [
+            ('1', Decimal('1890'), Decimal('3.35'), '6'),
+            ('2', Decimal('945'), Decimal('2.55'), '3'),
+        ])
+
+    def test_checkout_plan(self):
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(self.product_blouse, 9)
+        cart1.add_item(self.product_skirt, 10)
+        ship1 = singpost(cart=cart1, service_type=('LOCAL_REGISTERED',''),
+            contact=self.contact_sg)
+        cost = ship1.cost()
+
+        order = Order.objects.create(site=self.site, contact=self.contact_sg,
+            shipping_model='LOCAL_REGISTERED', shipping_cost=cost)
+        update_orderitems(order, cart1)
+
+        orders = Order.objects.filter(id=order.id)
+        plan = list(manifest.plans_for_orders(orders))[0][1]
+        self.assertEqual(
+            [(p.weight, p.cost, p.surcharge) for p in plan.parcels],
+            [(p.weight, p.cost, p.surcharge)
+                for p in ship1.parcel_plan().parcels])
+        self.assertEqual([[(item.product, quantity)
+            for item, quantity in p.quantities()] for p in plan.parcels], [
+            [(self.product_blouse, 6)],
+            [(self.product_blouse, 3), (self.product_skirt, 9)],
+            [(self.product_skirt, 1)],
+        ])
+
+        # the stored plan is used as is
+        stored = OrderParcelPlan.objects.get(order=order)
+        data = json.loads(stored.plan)
+        data['parcels'][0]['cost'] = '9.99'
+        stored.plan = json.dumps(data)
+        stored.save()
+        plan = list(manifest.plans_for_orders(orders))[0][1]
+        self.assertEqual(plan.parcels[0].cost, Decimal('9.99'))
+
+        # unless the items changed after checkout
+        item = order.orderitem_set.get(product=self.product_skirt)
+        item.quantity = 1
+        item.save()
+        plan = list(manifest.plans_for_orders(orders))[0][1]
+        self.assertEqual([p.weight for p in plan.parcels],
+            [Decimal('1890'), Decimal('1060')])
+
+class RateCardTestCase(BaseTestCase):
+    def setUp(self):
+        super(RateCardTestCase, self).setUp()
+
+        self.old_card = tiers.current_rate_card()
+        self.new_card = tiers.RateCard(datetime.date(9999, 1, 1),
+            {
+                'LOCAL': tiers.ExplicitCostTiers(
+                    tiers=(
+                        (40,	Decimal('0.60')),
+                        (2000,	Decimal('4.00')),
+                    ),
+                    filter = tiers.CountryFilter(include=('SG',))
+                ),
+            },
+            (tiers.Surcharge(Decimal('3.00'), tiers.CountryFilter()),)
+        )
+        tiers.register_rate_card(self.new_card)
+
+    def tearDown(self):
+        tiers.unregister_rate_card(self.new_card)
+        self.assertTrue(tiers.current_rate_card() is self.old_card)
+
+    def test_rate_card_for_date(self):
+        self.assertTrue(tiers.current_rate_card() is self.old_card)
+        self.assertTrue(tiers.rate_card_for_date(datetime.date(2010, 1, 1))
+            is self.old_card)
+        self.assertTrue(tiers.rate_card_for_date(datetime.date(9998, 12, 31))
+            is self.old_card)
+        self.assertTrue(tiers.rate_card_for_date(datetime.date(9999, 1, 1))
+            is self.new_card)
+        self.assertTrue(tiers.rate_card_for_date(
+            datetime.datetime(9999, 6, 1, 12, 0)) is self.new_card)
+
+    def test_pricing_by_card(self):
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(self.product_blouse, 9)
+        lines = cart1.cartitem_set.all()
+        country = self.contact_sg.shipping_address.country
+
+        ship1 = singpost(cart=cart1, service_type=('LOCAL',''), contact=self.contact_sg)
+        self.assertEqual(ship1.cost(), Decimal('5.90'))
+
+        plan = tiers.plan_shipments('LOCAL', country, lines,
+            rate_card=self.old_card)
+        self.assertEqual(plan.cost, Decimal('5.90'))
+
+        plan = tiers.plan_shipments('LOCAL_REGISTERED', country, lines,
+            rate_card=self.new_card)
+        self.assertEqual(plan.cost, Decimal('14.00'))
+
+    def test_missing_service(self):
+        # the new card only has LOCAL
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(self.product_blouse, 9)
+        country = self.contact_my.shipping_address.country
+
+        self.assertEqual(tiers.resolve_tier('AIR', country,
+            rate_card=self.new_card), (None, tiers.INELIGIBLE_NO_SERVICE))
+        self.assertEqual(tiers.plan_shipments('SURFACE', country,
+            cart1.cartitem_set.all(), rate_card=self.new_card), None)
+
+        results = SingPostRateProvider(rate_card=self.new_card) \
+            .quote_many([cart1], [country])
+        self.assertEqual([(q.service_type_code, q.ineligibility)
+            for q in results[0] if q.service_type_code.startswith('AIR')], [
+            ('AIR', tiers.INELIGIBLE_NO_SERVICE),
+            ('AIR_REGISTERED', tiers.INELIGIBLE_NO_SERVICE),
+        ])
+
+    def test_current_rate_card(self):
+        # a card registered after today's card was cached takes over at once
+        today_card = tiers.RateCard(datetime.date.today(),
+            self.new_card.service_tiers, self.new_card.registered_surcharge)
+        tiers.register_rate_card(today_card)
+        try:
+            self.assertTrue(tiers.current_rate_card() is today_card)
+        finally:
+            tiers.unregister_rate_card(today_card)
+        self.assertTrue(tiers.current_rate_card() is self.old_card)
+
+        # an entry cached from another index is never trusted
+        tiers._current_rate_card = ((), self.new_card, None, None)
+        self.assertTrue(tiers.current_rate_card() is self.old_card)
+
+    def test_unregister(self):
+        self.assertRaises(ValueError, tiers.unregister_rate_card,
+            tiers.RateCard(datetime.date(2010, 1, 1), tiers.SERVICE_TIERS))
+
+class SurchargeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.card = tiers.RateCard(datetime.date(2010, 1, 1),
+            tiers.SERVICE_TIERS, tiers.REGISTERED_SURCHARGE,
+            surcharges={
+                None: (
+                    tiers.WeightBandSurcharge(
+                        ((500, '0.10'), (2000, '0.30')),
+                        tiers.CountryFilter()),
+                    ),
+                'REGISTERED': (
+                    tiers.ValueSurcharge('0.01', tiers.CountryFilter(),
+                        minimum='2.00'),
+                    ),
+            })
+        self.country = differential.Country('SG', 'AS')
+
+        blouse = differential.Product('blouse', Decimal('315'))
+        dress = differential.Product('dress', Decimal('42'))
+        self.lines = [
+            differential.CartItem(1, blouse, 9),
+            differential.CartItem(2, dress, 2),
+        ]
+        self.lines[0].unit_price = Decimal('59.90')
+        self.lines[1].unit_price = Decimal('300.00')
+
+    def test_service_types(self):
+        self.assertEqual(tiers.parse_service_type('AIR_REGISTERED'),
+            ('AIR', ('REGISTERED',)))
+        self.assertEqual(tiers.parse_service_type('LOCAL'), ('LOCAL', ()))
+        self.assertEqual(tiers.SERVICE_TYPE_CODES, (
+            'LOCAL', 'LOCAL_REGISTERED',
+            'SURFACE', 'SURFACE_REGISTERED',
+            'AIR', 'AIR_REGISTERED',
+        ))
+        self.assertEqual(dict(tiers.service_type_choices())['AIR_REGISTERED'],
+            'Airmail, registered (0% GST)')
+
+    def test_plan(self):
+        # [6 blouses], [3 blouses, 2 dresses]
+        plan = tiers.plan_shipments('LOCAL', self.country, self.lines,
+            rate_card=self.card)
+        self.assertEqual([p.surcharge for p in plan.parcels],
+            [Decimal('0.30'), Decimal('0.30')])
+
+        plan = tiers.plan_shipments('LOCAL_REGISTERED', self.country,
+            self.lines, rate_card=self.card)
+        self.assertEqual([p.value for p in plan.parcels],
+            [Decimal('359.40'), Decimal('779.70')])
+        self.assertEqual([p.surcharge for p in plan.parcels],
+            [Decimal('3.89'), Decimal('8.10')])
+
+    def test_quote(self):
+        codes = ('LOCAL', 'LOCAL_REGISTERED')
+        quote = CartQuote(self.country, codes, self.card)
+        for line in self.lines:
+            quote.add_line(line.id, line.product, line.quantity,
+                line.unit_price)
+
+        for code in codes:
+            plan = tiers.plan_shipments(code, self.country, self.lines,
+                rate_card=self.card)
+            self.assertEqual(quote.cost(code), plan.cost)
+
+class ProfilingTestCase(BaseTestCase):
+    def test_profile_costs(self):
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(self.product_blouse, 9)
+
+        shipper = singpost(cart=cart1, service_type=('LOCAL', ''),
+            contact=self.contact_sg)
+        with profiling.profile_costs() as profile:
+            cost = shipper.cost()
+        self.assertEqual(profile.stages['cost']['calls'], 1)
+        self.assertEqual(profiling.current_profile(), None)
+
+        # profiling doesn't change the cost
+        self.assertEqual(shipper.cost(), cost)
+
+    def test_setting_read_once(self):
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(self.product_blouse, 9)
+
+        reads = []
+        def config_value(group, key):
+            reads.append(key)
+            return False
+
+        old_config_value = shipper_module.config_value
+        shipper_module.config_value = config_value
+        try:
+            shipper = singpost(cart=cart1, service_type=('LOCAL', ''),
+                contact=self.contact_sg)
+            for i in range(3):
+                shipper.cost()
+        finally:
+            shipper_module.config_value = old_config_value
+        self.assertEqual(reads, ['SINGPOST_PROFILING'])
+
+    def test_stress(self):
+        report = profiling.stress(max_units=100)
+        self.assertEqual(set([run['units'] for run in report['runs']]),
+            set([10, 100]))
+
+        for run in report['runs']:
+            self.assertEqual(sorted(run['stages'].keys()),
+                ['partition', 'plan', 'quote', 'weight'])
+
+        if profiling.resource is not None:
+            self.assertTrue(report['max_rss_bytes'] > 0)
+            for run in report['runs']:
+                self.assertTrue(run['stages']['plan']['max_rss_bytes'] > 0)
+
+    def test_threads(self):
+        tracemalloc = profiling.tracemalloc
+        tracing = tracemalloc is not None and tracemalloc.is_tracing()
+
+        country = differential.Country('SG', 'AS')
+        blouse = differential.Product('blouse', Decimal('315'))
+        profiles = []
+
+        def plan(units):
+            lines = [differential.CartItem(1, blouse, units)]
+            with profiling.profile_costs() as profile:
+                profile.run('plan', tiers.plan_shipments, 'LOCAL', country,
+                    lines)
+            profiles.append((units, profile))
+
+        threads = [threading.Thread(target=plan, args=(units,))
+            for units in (10, 1000, 10, 1000)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(profiles), 4)
+        for units, profile in profiles:
+            self.assertEqual(profile.stages['plan']['calls'], 1)
+
+        if tracemalloc is not None:
+            self.assertEqual(tracemalloc.is_tracing(), tracing)
+
+            for units, profile in profiles:
+                self.assertTrue(profile.stages['plan']['peak_bytes'] > 0)
+
+class RateProviderTestCase(BaseTestCase):
+    def test_matches_shipper(self):
+        cart1 = Cart.objects.create(site=self.site)
+        cart1.add_item(self.product_blouse, 9)
+        cart1.add_item(self.product_skirt, 1)
+
+        contacts = (self.contact_sg, self.contact_my, self.contact_as,
+            self.contact_jo)
+        destinations = [c.shipping_address.country for c in contacts]
+
+        results = SingPostRateProvider().quote_many([cart1], destinations)
+        self.assertEqual(len(results), len(destinations))
+
+        for contact, quotes in zip(contacts, results):
+            self.assertEqual([q.service_type_code for q in quotes],
+                list(tiers.SERVICE_TYPE_CODES))
+
+            for quote in quotes:
+                shipper = singpost(cart=cart1, contact=contact,
+                    service_type=(quote.service_type_code, ''))
+                self.assertEqual(quote.valid, shipper.valid())
+                if quote.valid:
+                    self.assertEqual(quote.cost, shipper.cost())
+
+    def test_compare_rates(self):
+        blouse = differential.Product('blouse', Decimal('315'))
+        carts = [[differential.CartItem(1, blouse, n)] for n in (1, 9, 30)]
+        destinations = [differential.Country(*country)
+            for country in differential.COUNTRIES]
+
+        comparison = compare_rates([SingPostRateProvider()], carts,
+            destinations, threads=3)
+        self.assertEqual(len(comparison), len(carts) * len(destinations))
+
+        for i, quotes in enumerate(comparison):
+            cart = carts[i // len(destinations)]
+            destination = destinations[i % len(destinations)]
+
+            expected = []
+            for code in tiers.SERVICE_TYPE_CODES:
+                plan = tiers.plan_shipments(code, destination, cart)
+                if plan is not None:
+                    expected.append(plan.cost)
+
+            self.assertEqual([q.cost for q in quotes], sorted(expected))
+            for quote in quotes:
+                self.assertTrue(quote.cart is cart)
@@ -0,0 +1,1028 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+"""
+The SingPost rate card and the pricing engine behind Shipper. Nothing here
+depends on Django, so it can be exercised on its own.
+
+Once built, nothing here changes but the caches, filled by single dict
+assignments of values that never change, and the rate card registry, which
+is updated under a lock. Rate cards, tiers and the functions below can be
+shared between threads.
+"""
+try:
+    from decimal import getcontext, Decimal, InvalidOperation, ROUND_HALF_UP
+except:
+    from django.utils._decimal import getcontext, Decimal, InvalidOperation, \
+        ROUND_HALF_UP
+
+import bisect
+import datetime
+import hashlib
+import heapq
+import itertools
+import threading
+
+from weights import grams_for_product
+
+import logging
+log = logging.getLogger('singpost.tiers')
+
+def safe_get_decimal(val):
+    try:
+        d = Decimal(val)
+    except (ValueError, TypeError, InvalidOperation):
+        d = Decimal(0)
+
+    return d
+
+class CountryFilter(object):
+    """
+    If a country is found in the exclude tuple, return False immediately.
+
+    A positive match for countries and continents (referred to as x) occurs
+    when:
+    1. The relevant tuple is None, OR
+
+    2i). The relevant tuple is not empty, AND
+    2ii). x is found found in the relevant tuple
+
+    If there is a positive match for both the country and continent, return
+    True.
+    """
+    def __init__(self, include=None, exclude=None,
+        include_continent=None):
+        self.include = include
+        self.exclude = exclude
+
+        self.include_continent = include_continent
+
+    def country_is_included(self, country):
+        if not self.exclude == None and len(self.exclude) \
+            and country.iso2_code in self.exclude:
+            return False
+
+        match_continent = False
+        match_country = False
+
+        if self.include_continent == None or \
+            (len(self.include_continent) and country.continent in self.include_continent):
+            match_continent = True
+
+        if self.include == None or \
+            (len(self.include) and country.iso2_code in self.include):
+            match_country = True
+
+        return match_continent and match_country
+
+class BaseCostTiers(object):
+    def __init__(self, tiers, filter=CountryFilter()):
+        self.tiers = tiers
+
+        self.maximum_item_weight = None
+        self.filter = filter
+
+    def get_lowest_cost(self):
+        return reduce(lambda x, y: x if x < y else y, self.tiers)[1]
+
+    def get_heaviest_weight_tier(self):
+        return reduce(lambda x, y: x if x > y else y, self.tiers)
+
+    def get_heaviest_weight(self):
+        return self.get_heaviest_weight_tier()[0]
+
+    def cost_for_shipment_with_weight(self, shipment_weight):
+        raise NotImplementedError
+
+    """
+    Returns a list of shipments.
+    """
+    def partitioned_shipments(self, total_weight, cart):
+        return self.partitioned_lines(total_weight, cart.cartitem_set.all())
+
+    """
+    Returns a list of shipments, each a list with an entry for every unit of
+    the lines (cart or order items) in it.
+    """
+    def partitioned_lines(self, total_weight, lines):
+        raise NotImplementedError
+
+class ExplicitCostTiers(BaseCostTiers):
+    def __init__(self, *args, **kwargs):
+        super(ExplicitCostTiers, self).__init__(*args, **kwargs)
+
+        self.maximum_item_weight = self.get_heaviest_weight()
+
+    """
+    The weight of a single must fall within specified "tiers", therefore the
+    maximum allowed weight of a single item is the heaviest weight
+    specified in tiers.
+    """
+    def cost_for_shipment_with_weight(self, shipment_weight):
+        if (shipment_weight > self.maximum_item_weight):
+            log.error("shipment weight exceeds maximum allowed weight: " \
+                "weight=%d, max=%d" \
+                % (shipment_weight, self.maximum_item_weight))
+            return None
+
+        prev = None
+        result_cost = None
+
+        for weight, cost in self.tiers:
+            if shipment_weight <= Decimal(weight):
+                if prev:
+                    if shipment_weight > Decimal(prev):
+                        result_cost = cost
+                        break
+            else:
+                prev = weight
+
+        return result_cost
+
+    def partitioned_lines(self, total_weight, lines):
+        shipments = []
+        a_shipment = []
+
+        if total_weight < self.maximum_item_weight:
+            # optimized version - no need to check weight for every item
+            for cartitem in lines:
+                for i in xrange(cartitem.quantity):
+                    a_shipment.append(cartitem)
+        else:
+            the_weight = Decimal(0)
+            new_weight = None
+            for cartitem in lines:
+                product_weight = grams_for_product(cartitem.product)
+                for i in xrange(cartitem.quantity):
+                    new_weight = the_weight + product_weight
+
+                    if new_weight <= self.maximum_item_weight:
+                        the_weight = new_weight
+                        a_shipment.append(cartitem)
+
+                        if new_weight == self.maximum_item_weight:
+                            shipments.append(a_shipment)
+                            a_shipment = []
+                    elif len(a_shipment) > 0 and the_weight > Decimal(0):
+                        shipments.append(a_shipment)
+                        a_shipment = [cartitem]
+                        the_weight = product_weight
+                    else:
+                        log.error("item exceeds max weight: " \
+                            "name=%s, weight=%d" \
+                            % (cartitem.product.name, product_weight))
+                        return None
+
+        if len(a_shipment):
+            shipments.append(a_shipment)
+
+        return shipments
+
+class ImplicitCostTiers(ExplicitCostTiers):
+    """
+    implied_tier --- A tuple of (weight_step, Decimal(n)) form. When weight
+    exceeds the last specified weight in tiers, cost is added for every
+    additional weight_step.
+    """
+    def __init__(self, implied_tier, maximum_item_weight,
+        *args, **kwargs):
+        super(ImplicitCostTiers, self).__init__(*args, **kwargs)
+
+        self.maximum_item_weight = maximum_item_weight
+        self.implied_tier = implied_tier
+
+    def cost_for_shipment_with_weight(self, shipment_weight):
+        max_tier = self.get_heaviest_weight_tier()
+
+        if (shipment_weight <= max_tier[0]):
+            prev = None
+            result_cost = None
+
+            for weight, cost in self.tiers:
+                if shipment_weight <= Decimal(weight):
+                    if prev:
+                        if shipment_weight > Decimal(prev):
+                            result_cost = cost
+                            break
+                else:
+                    prev = weight
+        else:
+            result = getcontext().divmod(
+                Decimal(shipment_weight - max_tier[0]),
+                Decimal(self.implied_tier[0]))
+            steps = result[0] + (1 if result[1] > Decimal(0) else 0)
+            result_cost = max_tier[1] + steps * self.implied_tier[1]
+
+        return result_cost
+
+class ZonedCostTiers(ImplicitCostTiers):
+    def __init__(self, maximum_item_weight=None,
+        *args, **kwargs):
+        super(ZonedCostTiers, self).__init__(
+            maximum_item_weight=maximum_item_weight,
+            *args, **kwargs)
+
+class ZonedCostTiersSet(BaseCostTiers):
+    def __init__(self, zones, maximum_item_weight, tiers=None,
+        *args, **kwargs):
+        super(ZonedCostTiersSet, self).__init__(tiers=tiers,
+            *args, **kwargs)
+
+        self.maximum_item_weight = maximum_item_weight
+
+        for zone in zones:
+            zone.maximum_item_weight = self.maximum_item_weight
+
+        self.zones = zones
+
+    def tier_for_country(self, country):
+        for zone in self.zones:
+            if zone.filter.country_is_included(country):
+                return zone
+
+        log.error('Could not determine zone for country:' \
+        'country=%s' % country)
+        return None
+
+SERVICE_TIERS = {
+    'LOCAL': ExplicitCostTiers(
+        tiers=(
+            (40,	Decimal('0.50')),
+            (100,	Decimal('0.80')),
+            (250,	Decimal('1.00')),
+            (500,	Decimal('1.50')),
+            (1000,	Decimal('2.55')),
+            (2000,	Decimal('3.35'))
+        ),
+        filter = CountryFilter(include=('SG',))
+    ),
+    'SURFACE': ImplicitCostTiers(
+        tiers=(
+            (20,	Decimal('0.50')),
+            (50,	Decimal('0.70')),
+            (100,	Decimal('1.00'))
+        ),
+        implied_tier=(100, Decimal('1.00')),
+        maximum_item_weight=2000,
+        filter = CountryFilter(exclude=('MY', 'BN'))
+    ),
+    'AIR': ZonedCostTiersSet(
+        zones=(
+            ZonedCostTiers(
+                tiers=(
+                    (20,	Decimal('0.45')),
+                    (50,	Decimal('0.55')),
+                    (100,	Decimal('0.85'))
+                ),
+                implied_tier=(100, Decimal('1.00')),
+                filter = CountryFilter(include=('MY', 'BN'))
+            ),
+            ZonedCostTiers(
+                tiers=(
+                    (20,	Decimal('0.65')),
+                ),
+                implied_tier=(10, Decimal('0.25')),
+                filter = CountryFilter(
+                    include=(
+                        'AS', # American Samoa
+                        'KI', # Kiribati
+                        'NR', # Nauru
+                        'SB', # Solomon Islands
+                        'BD', # Bangladesh
+                        'KP', # Korea, Dem. People's Rep. of
+                        'NP', # Nepal
+                        'LK', # Sri Lanka
+                        'BT', # Bhutan
+                        'KR', # Korea, Rep. of (South)
+                        'NC', # New Caledonia
+                        'TW', # Taiwan
+                        'KH', # Cambodia
+                        'LA', # Lao
+                        'MP', # Northern Mariana Islands
+                        'TH', # Thailand
+                        'CN', # China
+                        'MO', # Macao
+                        'PK', # Pakistan
+                        'TL', # Timor-Leste
+                        'FJ', # Fiji
+                        'MV', # Maldives
+                        'PW', # Palau
+                        'TO', # Tonga
+                        'PF', # French Polynesia
+                        'MH', # Marshall Islands
+                        'PG', # Papua New Guinea
+                        'TV', # Tuvalu
+                        'GU', # Guam
+                        'FM', # Micronesia, Fed. States of
+                        'PH', # Philippines
+                        'VU', # Vanuatu
+                        'HK', # Hong Kong
+                        'MN', # Mongolia
+                        'PN', # Pitcairn Islands
+                        'VN', # Viet Nam
+                        'IN', # India
+                        'MM', # Myanmar
+                        'WS', # Samoa
+                        'WF', # Wallis and Futuna
+                        'ID', # Indonesia
+                    )
+                )
+            ),
+            ZonedCostTiers(
+                tiers=(
+                    (20,	Decimal('1.10')),
+                ),
+                implied_tier=(10, Decimal('0.35'))
+            ),
+        ),
+        maximum_item_weight=2000,
+        filter = CountryFilter(exclude=('SG'))
+    ),
+
+    'LOCAL_REGISTERED': None,
+    'SURFACE_REGISTERED': None,
+    'AIRMAIL_REGISTERED': None,
+}
+
+HAS_SURCHARGE_PATTERN = '^(.+)_REGISTERED$'
+
+CENT = Decimal('0.01')
+
+class Surcharge(object):
+    """
+    An additional charge to be applied on top of the cost calculated by a
+    :ref:`singpost.shipper.BaseCostTier <tier>`.
+
+    Satchmo doesn't allow one to this very easily on a per-service basis, so we
+    just present a totally separate service to the user.
+
+    :param: charge: The additional fee to be applied.
+    """
+    flat = True
+
+    def __init__(self, charge, filter):
+       self.charge = safe_get_decimal(charge or 0)
+       self.filter = filter
+
+    def charge_for(self, weight, value):
+        """
+        Returns the charge for a shipment of the given shippable weight and
+        declared value.
+        """
+        return self.charge
+
+class WeightBandSurcharge(Surcharge):
+    """
+    A surcharge that depends on the weight of a shipment.
+
+    :param: bands: A tuple of (weight, charge) pairs in increasing order of
+    weight. A shipment is charged for the first band it doesn't exceed, or
+    the last band if it exceeds all of them.
+    """
+    flat = False
+
+    def __init__(self, bands, filter):
+        super(WeightBandSurcharge, self).__init__(0, filter)
+        self.bands = tuple([(Decimal(weight), safe_get_decimal(charge))
+            for weight, charge in bands])
+
+    def charge_for(self, weight, value):
+        for band_weight, charge in self.bands:
+            if weight <= band_weight:
+                return charge
+
+        return self.bands[-1][1]
+
+class ValueSurcharge(Surcharge):
+    """
+    A surcharge proportional to the declared value of a shipment, such as
+    insurance.
+
+    :param: rate: The fraction of the value charged.
+    :param: minimum: The least that is charged for a shipment.
+    """
+    flat = False
+
+    def __init__(self, rate, filter, minimum=0):
+        super(ValueSurcharge, self).__init__(0, filter)
+        self.rate = safe_get_decimal(rate)
+        self.minimum = safe_get_decimal(minimum)
+
+    def charge_for(self, weight, value):
+        charge = (value * self.rate).quantize(CENT, rounding=ROUND_HALF_UP)
+        if charge < self.minimum:
+            return self.minimum
+
+        return charge
+
+REGISTERED_SURCHARGE = (
+    Surcharge(Decimal('2.24'), CountryFilter(include=('SG'))),
+    Surcharge(Decimal('2.20'), CountryFilter(exclude=('SG'))),
+)
+
+# Options that can be added to a service. A rate card lists the surcharges of
+# each option under its code, and a service is named by appending the codes of
+# its options to the tier code, e.g. AIR_REGISTERED.
+SURCHARGE_OPTIONS = (
+    ('REGISTERED', 'registered'),
+)
+
+# (tier code, description, tax note) of each service tier
+SERVICE_DESCRIPTIONS = (
+    ('LOCAL', 'Local mail', 'inclusive of 7% GST'),
+    ('SURFACE', 'Surface mail', '0% GST'),
+    ('AIR', 'Airmail', '0% GST'),
+)
+
+def service_type_choices():
+    """
+    Returns a (code, description) pair for every service tier, on its own and
+    with each combination of SURCHARGE_OPTIONS.
+    """
+    choices = []
+    for tier_code, description, tax in SERVICE_DESCRIPTIONS:
+        for n in range(len(SURCHARGE_OPTIONS) + 1):
+            for options in itertools.combinations(SURCHARGE_OPTIONS, n):
+                code = '_'.join([tier_code] + [o[0] for o in options])
+                label = ', '.join([description] + [o[1] for o in options])
+                choices.append((code, '%s (%s)' % (label, tax)))
+
+    return tuple(choices)
+
+SERVICE_TYPE_CODES = tuple([code for code, description in
+    service_type_choices()])
+
+_parsed_services = {}
+
+def parse_service_type(service_type_code):
+    """
+    Splits a service code into its tier code and options, e.g. AIR_REGISTERED
+    into ('AIR', ('REGISTERED',)).
+    """
+    try:
+        return _parsed_services[service_type_code]
+    except KeyError:
+        pass
+
+    tier_code = service_type_code
+    options = []
+
+    found = True
+    while found:
+        found = False
+        for option, description in SURCHARGE_OPTIONS:
+            suffix = '_' + option
+            if tier_code.endswith(suffix) and len(tier_code) > len(suffix):
+                tier_code = tier_code[:-len(suffix)]
+                options.insert(0, option)
+                found = True
+                break
+
+    result = (tier_code, tuple(options))
+    _parsed_services[service_type_code] = result
+    return result
+
+class CompiledSurcharges(object):
+    """
+    The surcharges of a service to one destination, as resolved from a rate
+    card by compile_surcharges().
+
+    flat is the total of the surcharges charged the same for every shipment,
+    and rules the surcharges that depend on a shipment's weight or value.
+    """
+    def __init__(self, surcharges):
+        self.flat = Decimal(0)
+        self.rules = []
+
+        for surcharge in surcharges:
+            if surcharge.flat:
+                self.flat += surcharge.charge
+            else:
+                self.rules.append(surcharge)
+
+    def charge(self, weight, value):
+        """
+        Returns the total surcharge for a shipment.
+        """
+        charge = self.flat
+        for rule in self.rules:
+            charge += rule.charge_for(weight, value)
+
+        return charge
+
+    def charges(self, shipments):
+        """
+        Returns the total surcharge for each (weight, value) pair in
+        shipments.
+        """
+        if not self.rules:
+            return [self.flat] * len(shipments)
+
+        return [self.charge(weight, value) for weight, value in shipments]
+
+class RateCard(object):
+    """
+    A version of the rate card, used for orders placed on or after
+    effective_date until the next version takes effect.
+
+    :param: service_tiers: A dict of cost tiers like SERVICE_TIERS.
+    :param: registered_surcharge: Surcharges like REGISTERED_SURCHARGE, for
+    the REGISTERED option unless surcharges lists its own.
+    :param: surcharges: A dict mapping option codes to their surcharges. Of
+    the surcharges of an option, the last that applies to the destination is
+    charged. Surcharges under None are charged for every service.
+    """
+    def __init__(self, effective_date, service_tiers, registered_surcharge=(),
+        surcharges=None):
+        self.effective_date = effective_date
+        self.service_tiers = service_tiers
+
+        self.surcharges = dict(surcharges or {})
+        if registered_surcharge:
+            self.surcharges.setdefault('REGISTERED', registered_surcharge)
+        self.registered_surcharge = self.surcharges.get('REGISTERED', ())
+
+        self._resolved_tiers = {}
+        self._compiled_surcharges = {}
+        self._signature = None
+
+    def __repr__(self):
+        return '<RateCard effective %s>' % self.effective_date
+
+    def signature(self):
+        """
+        Returns a digest of the tier prices and weights in this card, which
+        is the same in every process.
+        """
+        if self._signature is None:
+            parts = []
+            for code in sorted(self.service_tiers.keys()):
+                tier = self.service_tiers[code]
+                if tier is None:
+                    continue
+
+                for zone in getattr(tier, 'zones', None) or (tier,):
+                    parts.append((code, zone.tiers,
+                        getattr(zone, 'implied_tier', None),
+                        zone.maximum_item_weight))
+
+            self._signature = hashlib.md5(repr(parts)).hexdigest()
+
+        return self._signature
+
+RATE_CARDS = [
+    RateCard(datetime.date.min, SERVICE_TIERS, REGISTERED_SURCHARGE),
+]
+
+# (effective dates, cards) as of the last register_rate_card(), replaced as
+# a whole so that readers in other threads see a consistent pair
+_rate_card_index = (tuple([card.effective_date for card in RATE_CARDS]),
+    tuple(RATE_CARDS))
+_rate_card_lock = threading.Lock()
+
+# (index snapshot, card, first day, first day of the next card) for today;
+# None for an open end
+_current_rate_card = (None, None, None, None)
+
+def _reindex_rate_cards():
+    # called with _rate_card_lock held
+    global _rate_card_index
+
+    _rate_card_index = (tuple([c.effective_date for c in RATE_CARDS]),
+        tuple(RATE_CARDS))
+
+def _rate_card_position(dates, date):
+    index = bisect.bisect_right(dates, date) - 1
+    if index < 0:
+        index = 0
+
+    return index
+
+def register_rate_card(card):
+    """
+    Adds a rate card version, keeping RATE_CARDS ordered by effective date.
+    A card with the same effective date as an existing one replaces it.
+    """
+    _rate_card_lock.acquire()
+    try:
+        dates = [c.effective_date for c in RATE_CARDS]
+        index = bisect.bisect_left(dates, card.effective_date)
+        if index < len(RATE_CARDS) and \
+            RATE_CARDS[index].effective_date == card.effective_date:
+            RATE_CARDS[index] = card
+        else:
+            RATE_CARDS.insert(index, card)
+
+        _reindex_rate_cards()
+    finally:
+        _rate_card_lock.release()
+
+def unregister_rate_card(card):
+    """
+    Removes a rate card version added by register_rate_card(). Raises
+    ValueError if the card isn't registered, or is the only one.
+    """
+    _rate_card_lock.acquire()
+    try:
+        if card not in RATE_CARDS:
+            raise ValueError('Rate card is not registered: %r' % card)
+        if len(RATE_CARDS) == 1:
+            raise ValueError('Cannot remove the only rate card: %r' % card)
+
+        RATE_CARDS.remove(card)
+        _reindex_rate_cards()
+    finally:
+        _rate_card_lock.release()
+
+def rate_card_for_date(date):
+    """
+    Returns the rate card in effect on date (a date or datetime).
+    """
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+
+    dates, cards = _rate_card_index
+    return cards[_rate_card_position(dates, date)]
+
+def current_rate_card():
+    """
+    Returns the rate card in effect today. The result is kept until the next
+    card takes effect.
+    """
+    global _current_rate_card
+
+    snapshot = _rate_card_index
+    indexed, card, start, end = _current_rate_card
+    today = datetime.date.today()
+
+    if indexed is not snapshot or (start is not None and today < start) or \
+        (end is not None and today >= end):
+        # work from one (dates, cards) pair throughout, so a card registered
+        # meanwhile can't pair today's card with another card's dates
+        dates, cards = snapshot
+        index = _rate_card_position(dates, today)
+        card = cards[index]
+        if index > 0:
+            start = dates[index]
+        else:
+            start = None
+        if index + 1 < len(cards):
+            end = dates[index + 1]
+        else:
+            end = None
+
+        _current_rate_card = (snapshot, card, start, end)
+
+    return card
+
+def tier_code_for_service(service_type_code):
+    """
+    Returns the key into SERVICE_TIERS for a service, stripping any surcharge
+    options.
+    """
+    return parse_service_type(service_type_code)[0]
+
+def compile_surcharges(service_type_code, country, rate_card=None):
+    """
+    Returns the CompiledSurcharges of a service to country. The current rate
+    card is used unless another is given.
+
+    The result only depends on the country's code and continent, so it is
+    cached per destination.
+    """
+    if rate_card is None:
+        rate_card = current_rate_card()
+
+    key = (service_type_code, country.iso2_code, country.continent)
+    try:
+        return rate_card._compiled_surcharges[key]
+    except KeyError:
+        pass
+
+    surcharges = []
+    for option in (None,) + parse_service_type(service_type_code)[1]:
+        s = None
+        for surcharge in rate_card.surcharges.get(option, ()):
+            if surcharge.filter.country_is_included(country):
+                s = surcharge
+
+        if s:
+            surcharges.append(s)
+
+    result = CompiledSurcharges(surcharges)
+    rate_card._compiled_surcharges[key] = result
+    return result
+
+def surcharge_for_service(service_type_code, country, rate_card=None):
+    """
+    Returns the part of a service's surcharges that is the same for every
+    shipment to country.
+    """
+    return compile_surcharges(service_type_code, country, rate_card).flat
+
+# Reasons for a service being ineligible, as returned by
+# ineligibility_for_lines()
+INELIGIBLE_DESTINATION = 'destination'
+INELIGIBLE_NO_ZONE = 'no-zone'
+INELIGIBLE_ITEM_WEIGHT = 'item-weight'
+INELIGIBLE_NO_SERVICE = 'no-service'
+
+def resolve_tier(service_type_code, country, rate_card=None):
+    """
+    Returns (tier, None) with the cost tier used by a service to ship to
+    country, or (None, reason) if the service doesn't ship there, or isn't
+    on the rate card. The current rate card is used unless another is given.
+
+    The result only depends on the country's code and continent, so it is
+    cached per destination.
+    """
+    if rate_card is None:
+        rate_card = current_rate_card()
+
+    key = (service_type_code, country.iso2_code, country.continent)
+    try:
+        return rate_card._resolved_tiers[key]
+    except KeyError:
+        pass
+
+    tier_code = tier_code_for_service(service_type_code)
+    tier = rate_card.service_tiers.get(tier_code)
+
+    if tier is None:
+        result = (None, INELIGIBLE_NO_SERVICE)
+    elif not tier.filter.country_is_included(country):
+        result = (None, INELIGIBLE_DESTINATION)
+    elif tier.tiers == None and hasattr(tier, 'zones'):
+        tier = tier.tier_for_country(country)
+        if tier == None:
+            result = (None, INELIGIBLE_NO_ZONE)
+        else:
+            result = (tier, None)
+    else:
+        result = (tier, None)
+
+    rate_card._resolved_tiers[key] = result
+    return result
+
+def tier_for_service(service_type_code, country, rate_card=None):
+    """
+    Returns the cost tier used by a service to ship to country, or None if
+    the service doesn't ship there.
+    """
+    return resolve_tier(service_type_code, country, rate_card)[0]
+
+def ineligibility_for_lines(service_type_code, country, lines,
+    rate_card=None):
+    """
+    Returns None if a service can ship lines (cart or order items) to
+    country, or one of the INELIGIBLE_* codes otherwise.
+
+    Only the destination and the weight of each shippable item are checked,
+    in a single pass over the lines, so nothing is partitioned or priced.
+    """
+    tier, reason = resolve_tier(service_type_code, country, rate_card)
+    if tier == None:
+        return reason
+
+    heaviest = Decimal(0)
+    for line in lines:
+        if line.product.is_shippable:
+            weight = grams_for_product(line.product)
+            if weight > heaviest:
+                heaviest = weight
+
+    if heaviest > tier.maximum_item_weight:
+        return INELIGIBLE_ITEM_WEIGHT
+
+    return None
+
+class Parcel(object):
+    """
+    One shipment of a ParcelPlan.
+
+    :param: items: The lines (cart or order items) in the shipment, with an
+    entry for every unit.
+    :param: weight: The shippable weight of the shipment.
+    :param: cost: The tier price for the weight.
+    :param: surcharge: The surcharge applied to the shipment.
+    :param: value: The declared value of the shipment, if a surcharge needed
+    it.
+    """
+    def __init__(self, items, weight, cost, surcharge, value=None):
+        self.items = items
+        self.weight = weight
+        self.cost = cost
+        self.surcharge = surcharge
+        self.value = value
+
+    def _get_total(self):
+        return self.cost + self.surcharge
+    total = property(_get_total)
+
+    def quantities(self):
+        """
+        Returns (line, quantity) pairs for the items, in order.
+        """
+        result = []
+        for item in self.items:
+            if result and result[-1][0] is item:
+                result[-1][1] += 1
+            else:
+                result.append([item, 1])
+
+        return [tuple(pair) for pair in result]
+
+class ParcelPlan(object):
+    """
+    The parcels a service splits a set of lines into, as priced.
+    """
+    def __init__(self, service_type_code, parcels):
+        self.service_type_code = service_type_code
+        self.parcels = parcels
+
+    def _get_cost(self):
+        total_cost = Decimal(0)
+        for parcel in self.parcels:
+            total_cost += parcel.cost + parcel.surcharge
+
+        return total_cost
+    cost = property(_get_cost)
+
+def weight_of_lines(lines):
+    """
+    Returns the total weight of the shippable units in lines.
+    """
+    total_weight = Decimal(0)
+
+    for line in lines:
+        if line.product.is_shippable:
+            total_weight += grams_for_product(line.product) * \
+                            safe_get_decimal(line.quantity)
+
+    return total_weight
+
+def line_value(line):
+    """
+    Returns the declared value of one unit of a line (cart or order item).
+    """
+    return safe_get_decimal(getattr(line, 'unit_price', 0))
+
+def plan_shipments(service_type_code, country, lines, rate_card=None):
+    """
+    Returns the ParcelPlan for shipping lines (cart or order items) to country
+    with a service, or None if the service can't be used. The current rate
+    card is used unless another is given.
+    """
+    if rate_card is None:
+        rate_card = current_rate_card()
+
+    tier = tier_for_service(service_type_code, country, rate_card)
+    if tier == None:
+        return None
+
+    lines = list(lines)
+    shipments = tier.partitioned_lines(weight_of_lines(lines), lines)
+    if shipments == None or not len(shipments):
+        return None
+
+    surcharges = compile_surcharges(service_type_code, country, rate_card)
+
+    unit_weights = {}
+    for line in lines:
+        if line.product.is_shippable:
+            unit_weights[id(line)] = grams_for_product(line.product)
+        else:
+            unit_weights[id(line)] = Decimal(0)
+
+    # unit prices are only looked up if a surcharge depends on them
+    if surcharges.rules:
+        unit_values = dict([(id(line), line_value(line)) for line in lines])
+
+    # a line's units are next to each other in a shipment, so each run of
+    # them is weighed and valued at once
+    weights = []
+    for shipment in shipments:
+        weight = Decimal(0)
+        value = None
+        if surcharges.rules:
+            value = Decimal(0)
+
+        for key, units in itertools.groupby(shipment, id):
+            count = sum(1 for unit in units)
+            weight += unit_weights[key] * count
+            if value is not None:
+                value += unit_values[key] * count
+
+        weights.append((weight, value))
+
+    parcels = []
+    for shipment, (weight, value), surcharge in zip(shipments, weights,
+        surcharges.charges(weights)):
+        cost = tier.cost_for_shipment_with_weight(weight)
+
+        # use the lightest class
+        if cost is None:
+            cost = tier.get_lowest_cost()
+
+        parcels.append(Parcel(shipment, weight, cost, surcharge, value))
+
+    return ParcelPlan(service_type_code, parcels)
+
+def plan_to_dict(plan, lines):
+    """
+    Returns a ParcelPlan as a dict of strings, numbers and lists, which can
+    be stored as JSON. lines are the lines the plan was made from; each
+    parcel lists its lines by their index in lines.
+    """
+    positions = dict([(id(line), i) for i, line in enumerate(lines)])
+
+    parcels = []
+    for parcel in plan.parcels:
+        value = None
+        if parcel.value is not None:
+            value = str(parcel.value)
+
+        parcels.append({
+            'weight': str(parcel.weight),
+            'cost': str(parcel.cost),
+            'surcharge': str(parcel.surcharge),
+            'value': value,
+            'lines': [[positions[id(line)], quantity]
+                for line, quantity in parcel.quantities()],
+        })
+
+    return {
+        'service': plan.service_type_code,
+        'lines': [[line.product.id, str(line.quantity)] for line in lines],
+        'parcels': parcels,
+    }
+
+def plan_from_dict(data, lines):
+    """
+    Returns the ParcelPlan stored by plan_to_dict(), with its parcels made up
+    of lines, or None if lines don't have the products and quantities of the
+    lines it was made from, in the same order.
+    """
+    lines = list(lines)
+    stored = [(product, Decimal(quantity))
+        for product, quantity in data['lines']]
+    if [(line.product.id, safe_get_decimal(line.quantity))
+        for line in lines] != stored:
+        return None
+
+    parcels = []
+    for parcel in data['parcels']:
+        items = []
+        for index, quantity in parcel['lines']:
+            items.extend([lines[index]] * quantity)
+
+        value = None
+        if parcel['value'] is not None:
+            value = Decimal(parcel['value'])
+
+        parcels.append(Parcel(items, Decimal(parcel['weight']),
+            Decimal(parcel['cost']), Decimal(parcel['surcharge']), value))
+
+    return ParcelPlan(data['service'], parcels)
+
+def shippers_by_cost(shippers):
+    """
+    Yields (cost, shipper) for every calculated shipper with a valid cost,
+    cheapest first. Ties keep the order in which the shippers were given.
+    Shippers that can't ship the cart have no lower bound and are skipped.
+
+    Shippers are ordered by cost_lower_bound() first, and cost() is only
+    evaluated for a shipper once its bound comes up for consideration, so
+    taking just the first result skips the partitioning of every service
+    whose bound exceeds the cheapest cost. The results are the same as
+    evaluating cost() for all of them and sorting.
+    """
+    heap = []
+    for index, shipper in enumerate(shippers):
+        bound = shipper.cost_lower_bound()
+        if bound is not None:
+            heap.append((bound, index, False, shipper))
+    heapq.heapify(heap)
+
+    while heap:
+        cost, index, exact, shipper = heapq.heappop(heap)
+        if exact:
+            yield cost, shipper
+            continue
+
+        cost = shipper.cost()
+        if cost is not None:
+            heapq.heappush(heap, (cost, index, True, shipper))
+
+def cheapest_shipper(shippers):
+    """
+    Returns the (cost, shipper) pair with the lowest cost, or None if none of
+    the shippers are valid.
+    """
+    for result in shippers_by_cost(shippers):
+        return result
+
+    return None
@@ -0,0 +1,87 @@
+"""
+Copyright (C) 2009-2010, Tay Ray Chuan
+
+Please see LICENCE for licensing details.
+"""
+
+"""
+Product weights in grams, the unit the rate card is written in.
+
+Each product's weight is converted from its weight_units once and cached by
+product id; the cached value is dropped when the product is saved or deleted,
+and is recomputed if the weight or units it was computed from have changed.
+"""
+try:
+    from decimal import Decimal, InvalidOperation
+except:
+    from django.utils._decimal import Decimal, InvalidOperation
+
+import logging
+log = logging.getLogger('singpost.weights')
+
+GRAMS = Decimal(1)
+
+WEIGHT_UNITS = {
+    'g': GRAMS,
+    'gm': GRAMS,
+    'gms': GRAMS,
+    'gram': GRAMS,
+    'grams': GRAMS,
+    'kg': Decimal(1000),
+    'kgs': Decimal(1000),
+    'lb': Decimal('453.59237'),
+    'lbs': Decimal('453.59237'),
+    'oz': Decimal('28.349523125'),
+}
+
+_weights = {}
+
+def grams_per_unit(weight_units):
+    """
+    Returns the number of grams in one of weight_units. Products without
+    units are taken to be in grams.
+    """
+    if not weight_units:
+        return GRAMS
+
+    try:
+        return WEIGHT_UNITS[weight_units.strip().lower()]
+    except KeyError:
+        log.warning('Unknown weight units, assuming grams: units=%s' \
+            % weight_units)
+        return GRAMS
+
+def _to_grams(weight, weight_units):
+    try:
+        d = Decimal(weight)
+    except (ValueError, TypeError, InvalidOperation):
+        return Decimal(0)
+
+    return d * grams_per_unit(weight_units)
+
+def grams_for_product(product):
+    """
+    Returns the weight of a product in grams, or 0 if it has no valid weight.
+    """
+    weight = product.weight
+    weight_units = getattr(product, 'weight_units', None)
+
+    key = getattr(product, 'id', None)
+    if key is None:
+        return _to_grams(weight, weight_units)
+
+    cached = _weights.get(key)
+    if cached is not None and cached[0] == weight and \
+        cached[1] == weight_units:
+        return cached[2]
+
+    grams = _to_grams(weight, weight_units)
+    _weights[key] = (weight, weight_units, grams)
+    return grams
+
+def forget_product_weight(sender, instance=None, **kwargs):
+    """
+    post_save and post_delete handler dropping a product's cached weight.
+    """
+    if instance is not None:
+        _weights.pop(instance.id, None)